@@ -4,6 +4,7 @@ from elastic.search import Search, ElasticQuery
 import json
 from elastic.elastic_settings import ElasticSettings
 from django.test.testcases import TestCase
+from criteria.helper.criteria import Criteria
 from criteria.helper.criteria_manager import CriteriaManager
 from criteria.helper.gene_criteria import GeneCriteria
 from elastic.utils import ElasticUtils
@@ -28,6 +29,13 @@ class CriteriaDataIntegrityTestUtils(TestCase):
             self.assertIn('score', property_keys)
             self.assertIn('disease_tags', property_keys)
             self.assertIn('qid', property_keys)
+            if Criteria.get_doc_layout(idx_type) == 'links':
+                '''check the links layout has the nested links with the disease'''
+                self.assertIn('links', property_keys)
+                links_mapping = elastic_type_mapping[idx]['mappings'][idx_type]['properties']['links']
+                self.assertEqual(links_mapping['type'], 'nested')
+                self.assertIn('disease', links_mapping['properties'])
+                continue
             '''check if all the enabled diseases are there'''
             for disease in site_enabled_diseases:
                 self.assertIn(disease, property_keys)
@@ -0,0 +1,122 @@
+import io
+import json
+import logging
+import queue
+import threading
+
+from elastic.management.loaders.loader import Loader
+
+
+logger = logging.getLogger(__name__)
+
+
+class CriteriaBulkLoader():
+    ''' Streaming bulk loader for criteria documents. Documents are serialized in to a reusable byte buffer and a
+    bulk request is sent when either the number of documents or the size of the buffer reaches its limit.
+    With threaded=True the bulk requests are sent from a background thread, fed by a bounded queue, so that
+    loading can go on while the scan of the source index is still running.
+    '''
+
+    def __init__(self, idx, idx_type, max_docs=5000, max_bytes=10485760, threaded=False, queue_size=4):
+        '''
+        @type  idx: string
+        @param idx: name of the index
+        @type  idx_type: string
+        @param idx_type: name of the idx type, each criteria is an index type
+        @type  max_docs: integer
+        @keyword max_docs: maximum number of documents in a bulk request
+        @type  max_bytes: integer
+        @keyword max_bytes: maximum size in bytes of a bulk request
+        @type  threaded: boolean
+        @keyword threaded: send the bulk requests from a background thread
+        @type  queue_size: integer
+        @keyword queue_size: maximum number of bulk requests waiting to be sent by the background thread
+        '''
+        self.idx = idx
+        self.idx_type = idx_type
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.buffer = io.BytesIO()
+        self.doc_count = 0
+        self.loaded_count = 0
+        self.error = None
+        self.queue = None
+        self.thread = None
+
+        if threaded:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self._consume, daemon=True)
+            self.thread.start()
+
+    def add(self, doc_id, doc):
+        ''' Add a document to the buffer, sending the bulk request when one of the limits is reached. '''
+        row_obj = {"index": {"_index": self.idx, "_type": self.idx_type, "_id": doc_id}}
+        self.add_action(row_obj, doc)
+
+    def add_action(self, action, doc):
+        ''' Add a bulk action (eg: index, update) and its document to the buffer. '''
+        self.buffer.write(json.dumps(action).encode('utf-8'))
+        self.buffer.write(b'\n')
+        self.buffer.write(json.dumps(doc).encode('utf-8'))
+        self.buffer.write(b'\n')
+        self.doc_count += 1
+
+        if self.doc_count >= self.max_docs or self.buffer.tell() >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        ''' Send the documents in the buffer and reset the buffer for reuse. '''
+        if self.doc_count == 0:
+            return
+
+        json_data = self.buffer.getvalue().decode('utf-8')
+        self.loaded_count += self.doc_count
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.doc_count = 0
+
+        if self.thread is not None:
+            self._check_error()
+            self.queue.put(json_data)
+        else:
+            self._bulk_load(json_data)
+
+    def wait(self):
+        ''' Send the documents in the buffer and wait for the background thread to send the bulk requests that
+        are queued, so that the documents can be read back. '''
+        self.flush()
+        if self.thread is not None:
+            self.queue.join()
+            self._check_error()
+
+    def close(self):
+        ''' Send any remaining documents and wait for the background thread to finish. '''
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self._check_error()
+
+    def _bulk_load(self, json_data):
+        print('.', end="", flush=True)
+        Loader().bulk_load(self.idx, self.idx_type, json_data)
+
+    def _consume(self):
+        while True:
+            json_data = self.queue.get()
+            if json_data is None:
+                self.queue.task_done()
+                break
+            try:
+                if self.error is None:
+                    self._bulk_load(json_data)
+            except Exception as e:
+                logger.critical('Bulk load to ' + self.idx + '/' + self.idx_type + ' failed: ' + str(e))
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
@@ -1,14 +1,21 @@
+import functools
 import json
 import logging
+import requests
+from concurrent.futures import ProcessPoolExecutor
 
+from criteria.helper.bulk_loader import CriteriaBulkLoader
 from criteria.helper.criteria_manager import CriteriaManager
+from criteria.helper.interval_index import IntervalIndex
+from criteria.helper.result_container import CompactResultContainer, CriteriaList, DiskResultContainer
 from data_pipeline.utils import IniParser
 from elastic.aggs import Agg, Aggs
 from elastic.elastic_settings import ElasticSettings
 from elastic.management.loaders.loader import Loader
 from elastic.management.loaders.mapping import MappingProperties
 from elastic.query import BoolQuery, RangeQuery, OrFilter, Query
-from elastic.search import Search, ElasticQuery, ScanAndScroll, Highlight
+from elastic.result import Document
+from elastic.search import Search, ElasticQuery, ScanAndScroll, Highlight, Sort
 from elastic.utils import ElasticUtils
 from disease.utils import Disease
 from region.utils import Region
@@ -18,23 +25,83 @@ import re
 logger = logging.getLogger(__name__)
 
 
+def criteria_fields(*fields):
+    ''' decorator to declare the _source fields a criteria method reads, eg:
+            @classmethod
+            @criteria_fields('study_id', 'genes', 'diseases', 'authors')
+            def cand_gene_in_study(cls, hit, section=None, config=None, result_container={}):
+        The fields are the _source projection of the scroll query for the section. When Criteria.check_fields is
+        set (in test mode) reading a field from hit['_source'] that is not declared raises a KeyError.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(cls, hit, *args, **kwargs):
+            if Criteria.check_fields and '_source' in hit:
+                hit = dict(hit, _source=DeclaredSource(hit['_source'], fields, func.__name__))
+            return func(cls, hit, *args, **kwargs)
+        wrapper.source_fields = list(fields)
+        return wrapper
+    return decorator
+
+
+class DeclaredSource(dict):
+    ''' _source of a hit that only allows the fields declared with criteria_fields to be read '''
+
+    def __init__(self, source, fields, name):
+        super().__init__(source)
+        self.fields = set(fields) | {'_id'}
+        self.name = name
+
+    def check(self, key):
+        if key not in self.fields:
+            raise KeyError(key + ' is read by ' + self.name + ' but is not declared with criteria_fields')
+
+    def __getitem__(self, key):
+        self.check(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self.check(key)
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        self.check(key)
+        return super().get(key, default)
+
+
 class Criteria():
     ''' Criteria class implementing common functions for all criteria types  '''
 
     (main_codes, other_codes) = CriteriaManager.get_available_diseases()
     site_enabled_diseases = main_codes + other_codes
     test_mode = False
+    check_fields = False
     gl_result_container = None
+    build_caches = {}
+    lookup_counters = {}
+
+    # flag of a criteria document that tags the feature to all the site diseases (see compact_all_diseases)
+    ALL_DISEASES = 'all_diseases'
+
+    # fields of the marker docs fetched by marker id (see get_docs_by_ids), the same for all the criterias so
+    # that a marker is fetched once a build
+    MARKER_SOURCES = ['id', 'seqid', 'info']
+    # idx type of the per feature rollup of the disease tags of all the criteria (see build_rollup), in its own
+    # index so that the searches of a criteria index without an idx type do not return the rollups
+    ROLLUP_TYPE = 'criteria_rollup'
 
     global hit_counter
     hit_counter = 0
 
     @classmethod
-    def process_criteria(cls, feature, section, config, sub_class, test=False):
+    def process_criteria(cls, feature, section, config, sub_class, test=False, slices=None):
         ''' Top level function that calls the right criteria implementation based on the subclass passed. Iterates over all the
             documents using the ScanAndScroll and the hits are processed by the inner function process_hits.
             The entire result is stored in result_container (a dict), and at the end of the processing, the result is
-            loaded in to the elastic index after creating the mapping
+            loaded in to the elastic index after creating the mapping. Sections with flush_pages set are flushed to
+            the criteria index every flush_pages scroll pages, merged with what has already been flushed (see
+            upsert_result_container). Sections with stream_load set (where every feature is complete once the page
+            it is in has been processed) are flushed page by page while the scan is still running.
         @type  feature: string
         @param feature: feature type, could be 'gene','region', 'marker' etc.,
         @type  section: string
@@ -43,54 +110,62 @@ class Criteria():
         @keyword config: The config object initialized from criteria.ini.
         @type  sub_class: string
         @param sub_class: The name of the inherited sub_class where the actual implementation is
+        @type  slices: integer
+        @keyword slices: Number of slices to split the scan into, each scanned by its own worker process
+                         (overrides scan_slices in the section config)
         '''
         global gl_result_container
-        gl_result_container = {}
         test_mode = test
+        Criteria.check_fields = test_mode
         if config is None:
             if test_mode:
                 config = CriteriaManager().get_criteria_config(ini_file='test_criteria.ini')
             else:
                 config = CriteriaManager().get_criteria_config(ini_file='criteria.ini')
+        gl_result_container = cls.new_result_container(section, config)
 
         section_config = config[section]
-        source_idx = section_config['source_idx']
-
-        if ',' in source_idx:
-            idxs = source_idx.split(',')
-            idx_all = [ElasticSettings.idx(idx) for idx in idxs]
-            source_idx = ','.join(idx_all)
-        else:
-            source_idx = ElasticSettings.idx(section_config['source_idx'])
-
-        source_idx_type = None
-        if 'source_idx_type' in section_config:
-            source_idx_type = section_config['source_idx_type']
-
-        if source_idx_type is not None:
-            source_idx = ElasticSettings.idx(section_config['source_idx'], idx_type=section_config['source_idx_type'])
-        else:
-            source_idx_type = ''
-
+        (source_idx, source_idx_type) = cls.get_source_idx(section, config)
         logger.warning(source_idx + ' ' + source_idx_type)
 
+        if section_config.getboolean('prefetch_meta', False):
+            cls.prefetch_index_meta(source_idx)
+
+        if slices is None:
+            slices = int(section_config.get('scan_slices', 1))
+        flush_pages = int(section_config.get('flush_pages', 0))
+        if flush_pages > 0 and slices > 1:
+            # the slices would merge their flushes of the same features at the same time
+            logger.warning(section + ': flush_pages is set, scanning with one cursor rather than ' + str(slices) +
+                           ' slices')
+            slices = 1
+        if flush_pages == 0 and section_config.getboolean('stream_load', False):
+            flush_pages = 1
+        page_count = 0
+
         def process_hits(resp_json):
             global gl_result_container
+            nonlocal page_count
             hits = resp_json['hits']['hits']
-            global hit_counter
-            for hit in hits:
-                hit_counter = hit_counter + 1
-
-                result_container = sub_class.tag_feature_to_disease(hit, section, config,
-                                                                    result_container=gl_result_container)
-                gl_result_container = result_container
-
-                if test_mode:
+            if test_mode:
+                # only need a handful of features in test mode
+                for hit in hits:
+                    gl_result_container = cls.process_page([hit], section, config, sub_class, gl_result_container)
                     if gl_result_container is not None and len(gl_result_container) > 5:
                         return
+            elif len(hits) > 0:
+                gl_result_container = cls.process_page(hits, section, config, sub_class, gl_result_container)
+                page_count += 1
+                if loader is not None and page_count % flush_pages == 0:
+                    cls.upsert_result_container(gl_result_container, loader)
+                    gl_result_container = cls.new_result_container(section, config)
 
         query = cls.get_elastic_query(section, config)
 
+        loader = None
+        if not test_mode and flush_pages > 0:
+            loader = cls.get_stream_loader(feature, section, config)
+
         if test_mode:
             result_size = len(gl_result_container)
             from_ = 0
@@ -118,9 +193,313 @@ class Criteria():
                 if gl_result_container is not None:
                     result_size = len(gl_result_container)
         else:
-            ScanAndScroll.scan_and_scroll(source_idx, call_fun=process_hits, query=query)
+            if slices > 1:
+                stream_to = None if loader is None else (loader.idx, loader.idx_type)
+                gl_result_container = cls.scan_slices(source_idx, query, section, config, sub_class, slices,
+                                                      stream_to=stream_to, flush_pages=flush_pages)
+            else:
+                ScanAndScroll.scan_and_scroll(source_idx, call_fun=process_hits, query=query)
 
-        cls.map_and_load(feature, section, config, gl_result_container)
+        cls.log_lookup_counters(section)
+        if loader is not None:
+            cls.upsert_result_container(gl_result_container, loader)
+            loader.close()
+            logger.warning(loader.idx + ' ' + loader.idx_type + ' loaded successfully. DONE')
+        else:
+            cls.map_and_load(feature, section, config, gl_result_container)
+
+    @classmethod
+    def process_criteria_shared(cls, feature_sections, config):
+        ''' function to build several criteria sections that have the same source index and type from one scan.
+            Every scroll page is passed to each of the sections, each with its own result container that is
+            loaded in to its own criteria index type at the end of the scan.
+        @type  feature_sections: list
+        @param feature_sections: list of (feature, section, sub_class) with the same source_idx and source_idx_type
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        '''
+        Criteria.check_fields = False
+        sections = [section for (feature, section, sub_class) in feature_sections]
+        (source_idx, source_idx_type) = cls.get_source_idx(sections[0], config)
+        logger.warning(source_idx + ' ' + source_idx_type + ' shared by ' + ', '.join(sections))
+
+        result_containers = {section: cls.new_result_container(section, config) for section in sections}
+
+        def process_hits(resp_json):
+            hits = resp_json['hits']['hits']
+            for (feature, section, sub_class) in feature_sections:
+                result_containers[section] = cls.process_page(hits, section, config, sub_class,
+                                                              result_containers[section])
+
+        query = cls.get_shared_elastic_query(sections, config)
+        ScanAndScroll.scan_and_scroll(source_idx, call_fun=process_hits, query=query)
+
+        cls.log_lookup_counters(', '.join(sections))
+        for (feature, section, sub_class) in feature_sections:
+            cls.map_and_load(feature, section, config, result_containers[section])
+
+    @classmethod
+    def get_shared_elastic_query(cls, sections, config):
+        ''' function to build the query for a scan shared by several criteria sections, the union of the
+            documents and of the _source fields each of the sections needs
+        @type  sections: list
+        @param sections: The sections in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        @return: L{Query} or None to scan all the documents with their full _source
+        '''
+        source_fields = []
+        section_filters = []
+        for section in sections:
+            fields = cls.get_source_fields(section, config)
+            if source_fields is not None and len(fields) > 0:
+                source_fields.extend(field for field in fields if field not in source_fields)
+            else:
+                source_fields = None
+
+            query_filter = cls.get_section_filter(config[section])
+            if section_filters is not None and query_filter is not None:
+                section_filters.append(query_filter)
+            else:
+                section_filters = None
+
+        if section_filters is not None:
+            query_bool = BoolQuery()
+            for query_filter in section_filters:
+                query_bool.should(query_filter)
+            return ElasticQuery.filtered_bool(Query.match_all(), query_bool, sources=source_fields)
+        elif source_fields is not None:
+            return ElasticQuery(Query.match_all(), sources=source_fields)
+        return None
+
+    @classmethod
+    def get_source_idx(cls, section, config):
+        ''' function to get the source index of a section, returns (source_idx, source_idx_type) where
+            source_idx includes the type (idx/idx_type) if the section has a source_idx_type
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        '''
+        section_config = config[section]
+        source_idx = section_config['source_idx']
+
+        if ',' in source_idx:
+            idxs = source_idx.split(',')
+            idx_all = [ElasticSettings.idx(idx) for idx in idxs]
+            source_idx = ','.join(idx_all)
+        else:
+            source_idx = ElasticSettings.idx(section_config['source_idx'])
+
+        source_idx_type = None
+        if 'source_idx_type' in section_config:
+            source_idx_type = section_config['source_idx_type']
+
+        if source_idx_type is not None:
+            source_idx = ElasticSettings.idx(section_config['source_idx'], idx_type=section_config['source_idx_type'])
+        else:
+            source_idx_type = ''
+        return (source_idx, source_idx_type)
+
+    @classmethod
+    def get_stream_loader(cls, feature, section, config):
+        ''' function to create the criteria mapping and a threaded bulk loader to stream the results to
+        @type  feature: string
+        @param feature: feature type, could be 'gene','region', 'marker' etc.,
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        '''
+        criteria_idx = cls.get_criteria_idx(feature, config)
+        cls.create_criteria_mapping(criteria_idx, section)
+        return CriteriaBulkLoader(criteria_idx, section, threaded=True)
+
+    @classmethod
+    def process_page(cls, hits, section, config, sub_class, result_container):
+        ''' function to pass each hit of a scroll page to the criteria implementation of the subclass. If the
+            subclass defines <section>_batch it is preferred and called once with all the hits of the page, eg:
+                def cand_gene_in_study_batch(cls, hits, section=None, config=None, result_container={}):
+            and returns the updated result_container. Otherwise, if the subclass defines <section>_prefetch it is
+            called first with all the hits of the page, so that the lookups for the page can be done in batches.
+        @type  hits: list
+        @param hits: list of hits from a page of the scan
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        @type  sub_class: string
+        @param sub_class: The name of the inherited sub_class where the actual implementation is
+        @type result_container : string
+        @keyword result_container: Container object for storing the result with keys as the feature_id
+        '''
+        global hit_counter
+        batch = getattr(sub_class, section + '_batch', None)
+        if batch is not None:
+            hit_counter = hit_counter + len(hits)
+            return batch(hits, section, config, result_container=result_container)
+
+        prefetch = getattr(sub_class, section + '_prefetch', None)
+        if prefetch is not None and len(hits) > 0:
+            prefetch(hits, section, config)
+
+        for hit in hits:
+            hit_counter = hit_counter + 1
+            result_container = sub_class.tag_feature_to_disease(hit, section, config,
+                                                                 result_container=result_container)
+        return result_container
+
+    @classmethod
+    def get_scan_shards(cls, source_idx):
+        ''' function to get the number of primary shards to scan, the largest shard count of the source indexes
+        @type  source_idx: string
+        @param source_idx: source index (and type) to scan eg: 'regions_v0.0.5/hits'
+        '''
+        idx = source_idx.split('/')[0]
+        response = Search.elastic_request(ElasticSettings.url(), idx + '/_settings', is_post=False)
+        try:
+            idx_settings = response.json()
+            return max(int(settings['settings']['index']['number_of_shards']) for settings in idx_settings.values())
+        except:
+            logger.warning('Unable to get the number of shards for ' + idx)
+            return 1
+
+    @classmethod
+    def scan_slices(cls, source_idx, query, section, config, sub_class, slices, stream_to=None, flush_pages=0):
+        ''' function to split the scan of the source index into slices that are scanned at the same time, each
+            by its own worker process with its own result container. The shards of the source index are divided
+            between the slices (using the search preference) and the result containers of the slices are merged.
+        @type  source_idx: string
+        @param source_idx: source index (and type) to scan eg: 'regions_v0.0.5/hits'
+        @type  query: string
+        @param query: L{ElasticQuery} for the scan or None to scan all the documents
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        @type  sub_class: string
+        @param sub_class: The name of the inherited sub_class where the actual implementation is
+        @type  slices: integer
+        @param slices: number of slices, limited to the number of shards of the source index
+        @type  stream_to: tuple
+        @keyword stream_to: (idx, idx_type) for the slices to load their results page by page
+        @type  flush_pages: integer
+        @keyword flush_pages: with stream_to, flush the results every flush_pages pages (see
+                              upsert_result_container) rather than page by page
+        '''
+        shards = cls.get_scan_shards(source_idx)
+        slices = min(slices, shards)
+        slice_shards = [[str(shard) for shard in range(shards) if shard % slices == slice_id]
+                        for slice_id in range(slices)]
+        logger.warning(section + ': scanning ' + str(shards) + ' shards in ' + str(slices) + ' slices')
+
+        result_container = cls.new_result_container(section, config)
+        with ProcessPoolExecutor(max_workers=slices) as executor:
+            futures = [executor.submit(cls.scan_slice, source_idx, query, section, config, sub_class, shard_ids,
+                                       stream_to=stream_to, flush_pages=flush_pages)
+                       for shard_ids in slice_shards]
+            for future in futures:
+                result_container = cls.merge_result_containers(result_container, future.result())
+        return result_container
+
+    @classmethod
+    def scan_slice(cls, source_idx, query, section, config, sub_class, shard_ids, stream_to=None, flush_pages=0,
+                   time_to_keep_scroll=5):
+        ''' function to scan and scroll the given shards of the source index, returns the result container
+        @type  source_idx: string
+        @param source_idx: source index (and type) to scan eg: 'regions_v0.0.5/hits'
+        @type  query: string
+        @param query: L{ElasticQuery} for the scan or None to scan all the documents
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        @type  sub_class: string
+        @param sub_class: The name of the inherited sub_class where the actual implementation is
+        @type  shard_ids: list
+        @param shard_ids: list of shard numbers to scan
+        @type  stream_to: tuple
+        @keyword stream_to: (idx, idx_type) to load the results to page by page
+        @type  flush_pages: integer
+        @keyword flush_pages: with stream_to, flush the results every flush_pages pages (see
+                              upsert_result_container) rather than page by page
+        '''
+        url = ElasticSettings.url()
+        scroll = 'scroll=' + str(time_to_keep_scroll) + 'm'
+        url_search = (source_idx + '/_search?search_type=scan&' + scroll + '&preference=_shards:' +
+                      ','.join(shard_ids))
+
+        if query is None:
+            query_data = {"query": {"match_all": {}}}
+        else:
+            query_data = dict(query.query)
+        query_data.setdefault('size', 1000)
+
+        loader = None
+        if stream_to is not None:
+            loader = CriteriaBulkLoader(stream_to[0], stream_to[1], threaded=True)
+
+        result_container = cls.new_result_container(section, config)
+        resp_json = Search.elastic_request(url, url_search, data=json.dumps(query_data)).json()
+        # with search_type=scan the first response holds just the scroll id, only the pages with hits are counted
+        hits = resp_json['hits']['hits']
+        page_count = 0
+        while True:
+            if len(hits) > 0:
+                result_container = cls.process_page(hits, section, config, sub_class, result_container)
+                page_count += 1
+                if loader is not None and page_count % max(flush_pages, 1) == 0:
+                    cls.upsert_result_container(result_container, loader)
+                    result_container = cls.new_result_container(section, config)
+            resp_json = Search.elastic_request(url, '_search/scroll?' + scroll, data=resp_json['_scroll_id']).json()
+            hits = resp_json['hits']['hits']
+            if len(hits) == 0:
+                break
+
+        if loader is not None:
+            cls.upsert_result_container(result_container, loader)
+            result_container = cls.new_result_container(section, config)
+            loader.close()
+        cls.log_lookup_counters(section + ' (shards ' + ','.join(shard_ids) + ')')
+        return result_container
+
+    @classmethod
+    def merge_result_containers(cls, result_container, other_container):
+        ''' function to merge the results of other_container in to result_container
+        @type result_container : string
+        @keyword result_container: Container object for storing the result with keys as the feature_id
+        @type other_container : string
+        @keyword other_container: Container object with the results to merge
+        '''
+        for feature_id, criteria_disease_dict in other_container.items():
+            for disease, criteria_dicts in criteria_disease_dict.items():
+                for criteria_dict in criteria_dicts:
+                    result_container = cls.populate_container(criteria_dict['fid'], criteria_dict['fname'],
+                                                              fnotes=criteria_dict.get('fnotes'),
+                                                              features=[feature_id], diseases=[disease],
+                                                              result_container=result_container)
+        if isinstance(other_container, DiskResultContainer):
+            other_container.close()
+        return result_container
+
+    @classmethod
+    def new_result_container(cls, section, config):
+        ''' function to create an empty result container of the type set by result_container in the section:
+            dict (the default), compact (L{CompactResultContainer}, for the sections with the most results) or
+            disk (L{DiskResultContainer}, spills to a local file when the working set reaches spill_features)
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        '''
+        section_config = config[section]
+        container_type = section_config.get('result_container', 'dict').strip()
+        if container_type == 'compact':
+            return CompactResultContainer()
+        if container_type == 'disk':
+            return DiskResultContainer(max_features=int(section_config.get('spill_features', 100000)),
+                                       spill_dir=section_config.get('spill_dir'))
+        return {}
 
     @classmethod
     def get_elastic_query(cls, section=None, config=None):
@@ -132,11 +511,7 @@ class Criteria():
         @return: L{Query}
         '''
         section_config = config[section]
-        source_fields = []
-
-        if 'source_fields' in section_config:
-            source_fields_str = section_config['source_fields']
-            source_fields = source_fields_str.split(',')
+        source_fields = cls.get_source_fields(section, config)
 
         if 'mhc' in section:
             seqid = '6'
@@ -167,9 +542,14 @@ class Criteria():
         elif section == 'marker_is_gwas_significant_in_ic':
             # build a range query
             gw_sig_p = 0.00000005
-            query = ElasticQuery(RangeQuery("p_value", lte=gw_sig_p))
+            query = ElasticQuery(RangeQuery("p_value", lte=gw_sig_p),
+                                 sources=source_fields if len(source_fields) > 0 else None)
         else:
-            if len(source_fields) > 0:
+            query_filter = cls.get_section_filter(section_config)
+            if query_filter is not None:
+                query = ElasticQuery.filtered_bool(Query.match_all(), query_filter,
+                                                   sources=source_fields if len(source_fields) > 0 else None)
+            elif len(source_fields) > 0:
                 query = ElasticQuery(Query.match_all(), sources=source_fields)
             else:
                 # query = ElasticQuery(Query.match_all())
@@ -177,9 +557,82 @@ class Criteria():
 
         return query
 
+    @classmethod
+    def get_source_fields(cls, section, config):
+        ''' function to get the _source fields to scroll for a section, the fields declared with criteria_fields
+            on the criteria method or else source_fields in the section config. An empty list is the full _source.
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        '''
+        section_config = config[section]
+        sub_class = CriteriaManager.get_criteria_class(section_config.get('feature', '').strip())
+        source_fields = getattr(getattr(sub_class, section, None), 'source_fields', None)
+        if source_fields is not None:
+            return list(source_fields)
+
+        if 'source_fields' in section_config:
+            return [field.strip() for field in section_config['source_fields'].split(',')]
+        return []
+
+    @classmethod
+    def get_section_filter(cls, section_config):
+        ''' function to build the filter for the documents a criteria section can use, from the filter keys
+            of the section, so that the documents the criteria would reject are not scrolled. Each key is a comma
+            separated list:
+                filter_term : status=N            (alternative values separated by |, eg: status=N|n)
+                filter_exists : marker, disease
+                filter_must_not : disease_locus=TBC|tbc
+                filter_range : p_value<=5e-08     (<, <=, > or >=)
+        @type  section_config: string
+        @param section_config: The section of the config object initialized from criteria.ini.
+        @return: L{BoolQuery} or None if the section has no filter keys
+        '''
+        def field_values(filter_str):
+            for field_value in filter_str.split(','):
+                (field, value) = field_value.split('=', 1)
+                values = [v.strip() for v in value.split('|')]
+                yield (field.strip(), values)
+
+        def values_query(field, values):
+            return Query.term(field, values[0]) if len(values) == 1 else Query.terms(field, values)
+
+        query_bool = BoolQuery()
+        has_filter = False
+
+        if 'filter_term' in section_config:
+            for (field, values) in field_values(section_config['filter_term']):
+                query_bool.must(values_query(field, values))
+                has_filter = True
+
+        if 'filter_exists' in section_config:
+            for field in section_config['filter_exists'].split(','):
+                query_bool.must(Query({"exists": {"field": field.strip()}}))
+                has_filter = True
+
+        if 'filter_must_not' in section_config:
+            for (field, values) in field_values(section_config['filter_must_not']):
+                query_bool.must_not(values_query(field, values))
+                has_filter = True
+
+        if 'filter_range' in section_config:
+            range_ops = {'<': 'lt', '<=': 'lte', '>': 'gt', '>=': 'gte'}
+            for range_str in section_config['filter_range'].split(','):
+                match = re.match(r'^\s*([\w.]+)\s*(<=|>=|<|>)\s*(\S+)\s*$', range_str)
+                if match is None:
+                    raise ValueError('Invalid filter_range: ' + range_str)
+                query_bool.must(RangeQuery(match.group(1), **{range_ops[match.group(2)]: match.group(3)}))
+                has_filter = True
+
+        return query_bool if has_filter else None
+
     @classmethod
     def tag_feature_to_all_diseases(cls, feature_id, section, config, result_container={}):
-        ''' function to tag the feature to all the diseases, used to tag features in the MHC region
+        ''' function to tag the feature to all the diseases, used to tag features in the MHC region. With
+            compact_all_diseases set in the section the feature gets one ALL_DISEASES entry, loaded as an
+            all_diseases flag that the read helpers and the disease filters expand in to the entry and the
+            disease_tags per disease (see expand_all_diseases), rather than an entry per disease.
         @type  feature_id: string
         @keyword feature_id: Id of the feature (gene => gene_id, region=>region_id)
         @type  section: string
@@ -196,24 +649,13 @@ class Criteria():
         if config is None:
             config = IniParser.read_ini(ini_file='criteria.ini')
 
-        dis_dict = dict()
-        criteria_disease_dict = {}
+        if config[section].getboolean('compact_all_diseases', False):
+            return cls.populate_container(cls.ALL_DISEASES, cls.ALL_DISEASES, fnotes=None, features=[feature_id],
+                                          diseases=[cls.ALL_DISEASES], result_container=result_container_)
 
         for disease in cls.site_enabled_diseases:
-                dis_dict[disease] = []
-                criteria_dict = cls.get_criteria_dict(disease, disease)
-                if len(result_container_.get(feature_id, {})) > 0:
-
-                    criteria_disease_dict = result_container_[feature_id]
-                    criteria_disease_dict = cls.get_criteria_disease_dict([disease], criteria_dict,
-                                                                          criteria_disease_dict)
-
-                    result_container_[feature_id] = criteria_disease_dict
-                else:
-                    criteria_disease_dict = {}
-                    criteria_disease_dict = cls.get_criteria_disease_dict([disease], criteria_dict,
-                                                                          criteria_disease_dict)
-                    result_container_[feature_id] = criteria_disease_dict
+            result_container_ = cls.populate_container(disease, disease, fnotes=None, features=[feature_id],
+                                                       diseases=[disease], result_container=result_container_)
 
         return result_container_
 
@@ -229,17 +671,25 @@ class Criteria():
         @type result_container : string
         @keyword result_container: Container object for storing the result with keys as the feature_id
         '''
-        feature_upper = feature.upper()
-        criteria_type = 'CRITERIA_IDX_' + feature_upper
-
-        default_section = config['DEFAULT']
-        criteria_idx = default_section[criteria_type]
+        criteria_idx = cls.get_criteria_idx(feature, config)
         criteria_idx_type = section
 
         cls.create_criteria_mapping(criteria_idx, criteria_idx_type)
         cls.load_result_container(result_container, criteria_idx, criteria_idx_type)
         logger.warning(criteria_idx + ' ' + criteria_idx_type + ' loaded successfully. DONE')
 
+    @classmethod
+    def get_criteria_idx(cls, feature, config):
+        ''' function to get the name of the criteria index for a feature type from the DEFAULT section
+        @type  feature: string
+        @param feature: feature type, could be 'gene','region', 'marker' etc.,
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        '''
+        criteria_type = 'CRITERIA_IDX_' + feature.upper()
+        default_section = config['DEFAULT']
+        return default_section[criteria_type]
+
     @classmethod
     def get_criteria_dict(cls, fid, fname, fnotes={}):
         ''' function to create a criteria_dict initialized with fid, fname, and fnotes
@@ -272,12 +722,13 @@ class Criteria():
         '''
         for disease in diseases:
             if disease in criteria_disease_dict:
-                existing_dict = criteria_disease_dict[disease]
-                if criteria_dict not in existing_dict:
-                        existing_dict.append(criteria_dict)
-                        criteria_disease_dict[disease] = existing_dict
+                existing_list = criteria_disease_dict[disease]
+                if not isinstance(existing_list, CriteriaList):
+                    existing_list = CriteriaList(existing_list)
+                    criteria_disease_dict[disease] = existing_list
+                existing_list.append(criteria_dict)
             else:
-                criteria_disease_dict[disease] = [criteria_dict]
+                criteria_disease_dict[disease] = CriteriaList([criteria_dict])
 
         return criteria_disease_dict
 
@@ -297,11 +748,20 @@ class Criteria():
         props = MappingProperties(idx_type)
         props.add_property("score", "integer")
         props.add_property("disease_tags", "string", index="not_analyzed")
+        props.add_property("all_diseases", "boolean")
         props.add_property("qid", "string", index="not_analyzed")
         (main_codes, other_codes) = CriteriaManager().get_available_diseases()
 
-        for disease in main_codes + other_codes:
+        # the links layout maps one links object for all the diseases rather than an object per disease
+        if cls.get_doc_layout(idx_type) == 'links':
+            disease_fields = ['links']
+        else:
+            disease_fields = main_codes + other_codes
+
+        for disease in disease_fields:
             criteria_tags = MappingProperties(disease)
+            if disease == 'links':
+                criteria_tags.add_property("disease", "string", index="not_analyzed")
             criteria_tags.add_property("fid", "string", index="not_analyzed")
             criteria_tags.add_property("fname", "string", index="not_analyzed")
 
@@ -311,6 +771,9 @@ class Criteria():
             fnotes.add_property('linkdata', "string", index="not_analyzed")
             fnotes.add_property('linkvalue', "string", index="not_analyzed")
             criteria_tags.add_properties(fnotes)
+            if disease == 'links':
+                # nested so that a query on links.disease and links.fid (or fnotes) matches within one link
+                criteria_tags.mapping_properties[disease]['type'] = 'nested'
             props.add_properties(criteria_tags)
 
         ''' create index and add mapping '''
@@ -324,6 +787,11 @@ class Criteria():
         meta = {"desc": desc}
         if not test_mode:
             load.mapping(props, idx_type, meta=meta, analyzer=Loader.KEYWORD_ANALYZER, **options)
+            if cls.is_disease_partitioned(idx_type):
+                for disease in main_codes + other_codes:
+                    load.mapping(props, idx_type, meta=meta, analyzer=Loader.KEYWORD_ANALYZER,
+                                 indexName=cls.get_partition_idx(idx, disease), shards=1)
+                cls.create_partition_aliases(idx, main_codes + other_codes)
         return props
 
     @classmethod
@@ -385,6 +853,224 @@ class Criteria():
         res = elastic.search()
         return res.docs
 
+    @classmethod
+    def reset_build_caches(cls):
+        ''' function to clear the lookups cached for the duration of a build '''
+        Criteria.build_caches.clear()
+
+    @classmethod
+    def count_lookup(cls, name, hit=True):
+        ''' function to count a lookup served (hit) or not served (miss) by a cache
+        @type  name: string
+        @param name: name of the cache eg: 'ld_cache'
+        @type  hit: boolean
+        @keyword hit: True if the lookup was served from the cache
+        '''
+        counter = Criteria.lookup_counters.setdefault(name, {'hits': 0, 'misses': 0})
+        if hit:
+            counter['hits'] += 1
+        else:
+            counter['misses'] += 1
+
+    @classmethod
+    def log_lookup_counters(cls, section):
+        ''' function to log and reset the cache hit/miss counters of a criteria section
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        '''
+        for name, counter in sorted(Criteria.lookup_counters.items()):
+            logger.warning(section + ' ' + name + ': ' + str(counter['hits']) + ' hits, ' +
+                           str(counter['misses']) + ' misses')
+        Criteria.lookup_counters.clear()
+
+    @classmethod
+    def get_overlapping_features(cls, build, seqid, start, end, idx=None, idx_type=None):
+        ''' function to get the features (eg: study hits) overlapping a given stretch of region. The overlaps are
+            answered from an in-memory interval index of the build_info coordinates of idx/idx_type that is loaded
+            once per build. Falls back to the elastic query in fetch_overlapping_features if the index can not
+            be loaded.
+        @type  build: string
+        @param build: build info eg: '38'
+        @type  seqid: string
+        @param seqid: chromosome number
+        @type  start:  string
+        @param start: region start
+        @type  end:  string
+        @param end: region end
+        @type  idx: string
+        @param idx: name of the index
+        @type  idx_type: string
+        @param idx_type: name of the idx type
+        '''
+        interval_index = cls.get_build_info_index(idx, idx_type)
+        if interval_index is None:
+            return cls.fetch_overlapping_features(build, seqid, start, end, idx=idx, idx_type=idx_type)
+
+        # a document overlapping on more than one of its build_info entries is returned once
+        docs = []
+        doc_ids = set()
+        for doc in interval_index.overlaps((str(build), str(seqid)), start, end):
+            if doc.doc_id() not in doc_ids:
+                doc_ids.add(doc.doc_id())
+                docs.append(doc)
+        return docs
+
+    @classmethod
+    def get_build_info_index(cls, idx, idx_type):
+        ''' function to get the interval index of the build_info coordinates of the documents in idx/idx_type,
+            loaded with a scan of the index the first time it is used in a build.
+        @type  idx: string
+        @param idx: name of the index
+        @type  idx_type: string
+        @param idx_type: name of the idx type
+        '''
+        cache_key = ('build_info_index', idx, idx_type)
+        if cache_key in Criteria.build_caches:
+            return Criteria.build_caches[cache_key]
+
+        interval_index = IntervalIndex()
+
+        def add_hits(resp_json):
+            for hit in resp_json['hits']['hits']:
+                doc = Document(hit)
+                build_info = hit['_source'].get('build_info', [])
+                if isinstance(build_info, dict):
+                    build_info = [build_info]
+                for info in build_info:
+                    interval_index.add((str(info['build']), str(info['seqid'])), info['start'], info['end'], doc)
+
+        query = ElasticQuery(Query.match_all(), sources=['build_info.*', 'disease_locus', 'disease',
+                                                         'chr_band', 'species'])
+        try:
+            ScanAndScroll.scan_and_scroll(idx + '/' + idx_type, call_fun=add_hits, query=query)
+            logger.warning('Loaded ' + str(len(interval_index)) + ' build_info intervals from ' +
+                           idx + '/' + idx_type)
+        except Exception as e:
+            logger.warning('Unable to load build_info intervals from ' + idx + '/' + idx_type + ': ' + str(e))
+            interval_index = None
+
+        Criteria.build_caches[cache_key] = interval_index
+        return interval_index
+
+    @classmethod
+    def get_study_lookup(cls):
+        ''' function to get the study metadata table (study_id => {'first_author': ...}) loaded with a scan of the
+            STUDY index the first time it is used in a build and shared by all the criteria classes.
+        '''
+        if 'study_lookup' in Criteria.build_caches:
+            return Criteria.build_caches['study_lookup']
+
+        study_lookup = {}
+
+        def add_hits(resp_json):
+            for hit in resp_json['hits']['hits']:
+                study_lookup[hit['_id']] = cls.get_study_meta(hit['_source'])
+
+        query = ElasticQuery(Query.match_all(), sources=['authors'])
+        ScanAndScroll.scan_and_scroll(ElasticSettings.idx('STUDY', 'STUDY'), call_fun=add_hits, query=query)
+        logger.warning('Loaded ' + str(len(study_lookup)) + ' studies in to the study lookup')
+
+        Criteria.build_caches['study_lookup'] = study_lookup
+        return study_lookup
+
+    @classmethod
+    def get_study_meta(cls, study_doc):
+        ''' function to get the metadata kept in the study lookup from a study document '''
+        author = study_doc['authors'][0]
+        return {'first_author': author['name'] + ' ' + author['initials']}
+
+    @classmethod
+    def get_first_author(cls, study_id):
+        ''' function to get the first author (name and initials) of a study from the study lookup. A study that
+            is not in the lookup (eg: added since it was loaded) is fetched from the STUDY index.
+        @type  study_id: string
+        @param study_id: study id eg: GDXHsS00004
+        '''
+        study_lookup = cls.get_study_lookup()
+        Criteria.count_lookup('study_lookup', hit=study_id in study_lookup)
+        if study_id not in study_lookup:
+            query = ElasticQuery(Query.ids([study_id]))
+            elastic = Search(search_query=query, idx=ElasticSettings.idx('STUDY', 'STUDY'), size=1)
+            study_doc = elastic.search().docs[0]
+            study_lookup[study_id] = cls.get_study_meta({'authors': getattr(study_doc, 'authors')})
+        return study_lookup[study_id]['first_author']
+
+    @classmethod
+    def get_docs_by_ids(cls, idx, ids, sources=None, batch_size=1000, field=None):
+        ''' function to get documents by id, fetched with ids queries of up to batch_size ids and kept for
+            the rest of the build so that documents shared between features are only fetched once (as are the
+            ids that are not found). Returns a dict of id => Document, ids that are not found are left out.
+        @type  idx: string
+        @param idx: name of the index (idx/idx_type)
+        @type  ids: list
+        @param ids: document ids
+        @type  sources: list
+        @keyword sources: fields to fetch, all the documents of idx must be fetched with the same sources
+        @type  batch_size: integer
+        @keyword batch_size: maximum number of ids in a query
+        @type  field: string
+        @keyword field: field the ids are matched on with a terms query rather than the document _id, the first
+                        document is kept if more than one has the id (eg: a marker at more than one position)
+        '''
+        idx_docs = Criteria.build_caches.setdefault(('docs', idx) if field is None else ('docs', idx, field), {})
+        ids_to_fetch = []
+        for doc_id in ids:
+            Criteria.count_lookup('docs ' + idx, hit=doc_id in idx_docs)
+            if doc_id not in idx_docs and doc_id not in ids_to_fetch:
+                ids_to_fetch.append(doc_id)
+
+        for i in range(0, len(ids_to_fetch), batch_size):
+            batch_ids = ids_to_fetch[i:i + batch_size]
+            if field is None:
+                query = ElasticQuery(Query.ids(batch_ids), sources=sources)
+            else:
+                query = ElasticQuery(Query.terms(field, batch_ids), sources=sources)
+            result = Search(query, idx=idx, size=len(batch_ids)).search()
+            if result.hits_total > len(result.docs):
+                # more than one document for some of the ids, fetch all the hits rather than truncate them
+                result = Search(query, idx=idx, size=result.hits_total).search()
+            for doc in result.docs:
+                idx_docs.setdefault(doc.doc_id() if field is None else getattr(doc, field), doc)
+            for doc_id in batch_ids:
+                idx_docs.setdefault(doc_id, None)
+
+        return {doc_id: idx_docs[doc_id] for doc_id in ids if idx_docs.get(doc_id) is not None}
+
+    @classmethod
+    def prefetch_index_meta(cls, idx):
+        ''' function to fetch the mapping _meta of all the index types of idx (eg: all the IC statistics indexes)
+            with a single mapping request, kept for get_index_meta for the rest of the build.
+        @type  idx: string
+        @param idx: name of the index (or comma separated indexes, idx/idx_type)
+        '''
+        elastic_url = ElasticSettings.url()
+        try:
+            meta_response = Search.elastic_request(elastic_url, idx + '/_mapping', is_post=False)
+            elastic_meta = json.loads(meta_response.content.decode("utf-8"))
+        except Exception as e:
+            logger.warning('Unable to fetch the mapping of ' + idx + ': ' + str(e))
+            return
+
+        for index_name, index_mapping in elastic_meta.items():
+            for idx_type, type_mapping in index_mapping.get('mappings', {}).items():
+                Criteria.build_caches[('index_meta', index_name, idx_type)] = type_mapping.get('_meta')
+
+    @classmethod
+    def get_index_meta(cls, idx, idx_type):
+        ''' function to get the mapping _meta of an index type (eg: the disease and study of an IC statistics
+            index), fetched once per index type in a build.
+        @type  idx: string
+        @param idx: name of the index
+        @type  idx_type: string
+        @param idx_type: name of the idx type
+        '''
+        cache_key = ('index_meta', idx, idx_type)
+        Criteria.count_lookup('index_meta', hit=cache_key in Criteria.build_caches)
+        if cache_key not in Criteria.build_caches:
+            cls.prefetch_index_meta(idx + '/' + idx_type)
+            Criteria.build_caches.setdefault(cache_key, None)
+        return Criteria.build_caches[cache_key]
+
     @classmethod
     def calculate_score(cls, disease_list):
         ''' function to calculate score based on the disease tiers...core diseases gets 10 and non-score gets 5
@@ -406,7 +1092,7 @@ class Criteria():
         return score
 
     @classmethod
-    def load_result_container(cls, result_container, idx, idx_type):
+    def load_result_container(cls, result_container, idx, idx_type, loader=None):
         ''' function to load the results in to index using the bulk loader
         @type result_container : string
         @keyword result_container: Container object for storing the result with keys as the feature_id
@@ -414,41 +1100,474 @@ class Criteria():
         @param idx: name of the index
         @type  idx_type: string
         @param idx_type: name of the idx type, each criteria is an index type
+        @type  loader: L{CriteriaBulkLoader}
+        @keyword loader: bulk loader to stream the documents to, left open so it can be reused. If None a
+                         loader is created and closed once the result container is loaded.
         '''
-        json_data = ''
-        line_num = 0
+        close_loader = False
+        if loader is None:
+            loader = CriteriaBulkLoader(idx, idx_type)
+            close_loader = True
 
-        for feature_id in result_container:
+        doc_layout = cls.get_doc_layout(idx_type)
+        partitioned = cls.is_disease_partitioned(idx_type)
+
+        for feature_id, criteria_disease_dict in result_container.items():
 
             if feature_id is None:
                 continue
 
-            row_obj = {"index": {"_index": idx, "_type": idx_type, "_id": feature_id}}
-            row = result_container[feature_id]
-            disease_tags = list(row.keys())
+            row = cls.get_criteria_doc(feature_id, criteria_disease_dict)
+            if doc_layout == 'links':
+                row = cls.get_links_doc(row)
+            loader.add(feature_id, row)
+            if partitioned:
+                for disease in cls.get_partition_diseases(row):
+                    loader.add_action({"index": {"_index": cls.get_partition_idx(idx, disease), "_type": idx_type,
+                                                 "_id": feature_id}}, row)
+
+        if close_loader:
+            loader.close()
+        if isinstance(result_container, DiskResultContainer):
+            result_container.close()
 
-            if 'score' in disease_tags:
-                disease_tags.remove('score')
-            if 'disease_tags' in disease_tags:
-                disease_tags.remove('disease_tags')
+    @classmethod
+    def upsert_result_container(cls, result_container, loader):
+        ''' function to flush the results in to the criteria index. The criteria of a feature already flushed in
+            this build are merged with its document in the index, fetched once the loader has sent the earlier
+            flushes (see get_flushed_rows), and the whole merged document is loaded, so no update script (and no
+            scripting on the cluster) is needed.
+        @type result_container : string
+        @keyword result_container: Container object for storing the result with keys as the feature_id
+        @type  loader: L{CriteriaBulkLoader}
+        @param loader: bulk loader to send the documents to, left open so it can be reused
+        '''
+        flushed_ids = Criteria.build_caches.setdefault(('flushed_ids', loader.idx, loader.idx_type), set())
+        rows = {}
+        for feature_id, criteria_disease_dict in result_container.items():
+            if feature_id is not None:
+                rows[feature_id] = {disease: list(criteria_dicts)
+                                    for disease, criteria_dicts in criteria_disease_dict.items()}
+        if isinstance(result_container, DiskResultContainer):
+            result_container.close()
+
+        flushed = [feature_id for feature_id in rows if feature_id in flushed_ids]
+        if len(flushed) > 0:
+            loader.wait()
+            for feature_id, flushed_row in cls.get_flushed_rows(loader.idx, loader.idx_type, flushed).items():
+                rows[feature_id] = cls.merge_criteria_rows(flushed_row, rows[feature_id])
+        flushed_ids.update(rows.keys())
+        cls.load_result_container(rows, loader.idx, loader.idx_type, loader=loader)
 
+    @classmethod
+    def get_flushed_rows(cls, idx, idx_type, feature_ids, batch_size=1000):
+        ''' function to get the criteria of features already flushed to the criteria index, with realtime multi
+            gets of up to batch_size ids, returns a dict of feature id => {disease: [criteria dicts]} (with the
+            all_diseases flag if it is set)
+        @type  idx: string
+        @param idx: name of the index
+        @type  idx_type: string
+        @param idx_type: name of the idx type, each criteria is an index type
+        @type  feature_ids: list
+        @param feature_ids: Ids of the features
+        @type  batch_size: integer
+        @keyword batch_size: maximum number of ids in a multi get
+        '''
+        rows = {}
+        for i in range(0, len(feature_ids), batch_size):
+            response = Search.elastic_request(ElasticSettings.url(), idx + '/' + idx_type + '/_mget',
+                                              data=json.dumps({'ids': feature_ids[i:i + batch_size]}))
+            for doc in response.json().get('docs', []):
+                if not doc.get('found'):
+                    continue
+                row = {key: value for key, value in doc['_source'].items()
+                       if key not in ('score', 'disease_tags', 'qid')}
+                for link in row.pop('links', []):
+                    criteria_dict = dict(link)
+                    row.setdefault(criteria_dict.pop('disease'), []).append(criteria_dict)
+                rows[doc['_id']] = row
+        return rows
+
+    @classmethod
+    def merge_criteria_rows(cls, row, other_row):
+        ''' function to merge the criteria lists of other_row in to row, without duplicates, returns row
+        @type  row: dict
+        @param row: dict with keys as disease code and values as the list of criteria dicts
+        @type  other_row: dict
+        @param other_row: dict with keys as disease code and values as the list of criteria dicts
+        '''
+        for key, criteria_dicts in other_row.items():
+            if key == cls.ALL_DISEASES:
+                row[key] = criteria_dicts
+                continue
+            merged = row.setdefault(key, [])
+            seen = set(json.dumps(criteria_dict, sort_keys=True) for criteria_dict in merged)
+            for criteria_dict in criteria_dicts:
+                criteria_key = json.dumps(criteria_dict, sort_keys=True)
+                if criteria_key not in seen:
+                    seen.add(criteria_key)
+                    merged.append(criteria_dict)
+        return row
+
+    @classmethod
+    def get_criteria_doc(cls, feature_id, row):
+        ''' function to complete the criteria document of a feature with the score, disease_tags and qid
+        @type  feature_id: string
+        @keyword feature_id: Id of the feature (gene => gene_id, region=>region_id)
+        @type  row: dict
+        @param row: dict with keys as disease code and values as the list of criteria dicts
+        '''
+        all_diseases = row.get(cls.ALL_DISEASES) is not None
+        doc = {key: value for key, value in row.items() if key != cls.ALL_DISEASES}
+        disease_tags = list(doc.keys())
+
+        if 'score' in disease_tags:
+            disease_tags.remove('score')
+        if 'disease_tags' in disease_tags:
+            disease_tags.remove('disease_tags')
+        if 'qid' in disease_tags:
+            disease_tags.remove('qid')
+
+        if all_diseases:
+            # only the flag is stored, the entries and tags of the site diseases are left to expand_all_diseases
+            doc[cls.ALL_DISEASES] = True
+            score = cls.calculate_score(cls.site_enabled_diseases)
+        else:
             score = cls.calculate_score(disease_tags)
-            row['score'] = score
-            row['disease_tags'] = disease_tags
-            row['qid'] = feature_id
+        doc['score'] = score
+        doc['disease_tags'] = disease_tags
+        doc['qid'] = feature_id
+        return doc
+
+    @classmethod
+    def get_doc_layout(cls, idx_type):
+        ''' function to get the document layout of a criteria index type from doc_layout in its criteria.ini
+            section, disease (the default, an object per disease) or links (see get_links_doc)
+        @type  idx_type: string
+        @param idx_type: name of the idx type, each criteria is an index type
+        '''
+        return cls.get_idx_type_option(idx_type, 'doc_layout', 'disease')
+
+    @classmethod
+    def get_idx_type_option(cls, idx_type, option, default):
+        ''' function to get an option of the criteria.ini section of a criteria index type, cached for the build
+        @type  idx_type: string
+        @param idx_type: name of the idx type, each criteria is an index type
+        @type  option: string
+        @param option: name of the option in the section
+        @param default: value if the section does not set the option
+        '''
+        cache_key = ('idx_type_option', idx_type, option)
+        if cache_key not in cls.build_caches:
+            config = CriteriaManager.get_criteria_config()
+            value = default
+            if config is not None and idx_type in config and option in config[idx_type]:
+                value = config[idx_type][option].strip()
+            cls.build_caches[cache_key] = value
+        return cls.build_caches[cache_key]
+
+    @classmethod
+    def is_disease_partitioned(cls, idx_type):
+        ''' function to check if a criteria index type is also loaded in to the per disease partitions
+            (disease_partitions in its criteria.ini section)
+        @type  idx_type: string
+        @param idx_type: name of the idx type, each criteria is an index type
+        '''
+        return str(cls.get_idx_type_option(idx_type, 'disease_partitions', 'false')).lower() == 'true'
 
-            json_data += json.dumps(row_obj) + '\n'
-            json_data += json.dumps(row) + '\n'
+    @classmethod
+    def get_partition_idx(cls, idx, disease):
+        ''' function to get the name of the partition of a criteria index for a disease '''
+        return idx + '_' + disease.lower() + '_partition'
 
-            line_num += 1
+    @classmethod
+    def get_disease_alias(cls, idx, disease):
+        ''' function to get the alias of the partition of a criteria index for a disease '''
+        return idx + '_' + disease.lower()
 
-            if(line_num > 5000):
-                line_num = 0
-                print('.', end="", flush=True)
-                Loader().bulk_load(idx, idx_type, json_data)
-                json_data = ''
-        if line_num > 0:
-            Loader().bulk_load(idx, idx_type, json_data)
+    @classmethod
+    def get_partition_diseases(cls, doc):
+        ''' function to get the diseases of the partitions a criteria document is loaded in to '''
+        if doc.get(cls.ALL_DISEASES):
+            return cls.site_enabled_diseases
+        return doc['disease_tags']
+
+    @classmethod
+    def get_disease_idx(cls, idx, disease, idx_type=None):
+        ''' function to get the index to search for the criteria of a disease, the alias of the disease partition
+            if all the idx types are partitioned, otherwise the criteria index
+        @type  idx: string
+        @param idx: name of the index
+        @type  disease: string
+        @param disease: disease code eg: T1D
+        @type  idx_type: string
+        @keyword idx_type: comma separated idx types, each criteria is an index type
+        '''
+        if idx_type is None or idx_type == '':
+            return idx
+        if all(cls.is_disease_partitioned(criteria.strip()) for criteria in idx_type.split(',')):
+            return cls.get_disease_alias(idx, disease)
+        return idx
+
+    @classmethod
+    def create_partition_aliases(cls, idx, diseases):
+        ''' function to point the alias of each disease at its partition of the criteria index
+        @type  idx: string
+        @param idx: name of the index
+        @type  diseases: list
+        @param diseases: list of disease codes eg: ['T1D', 'MS']
+        '''
+        actions = [{"add": {"index": cls.get_partition_idx(idx, disease), "alias": cls.get_disease_alias(idx, disease)}}
+                   for disease in diseases]
+        Search.elastic_request(ElasticSettings.url(), '_aliases', data=json.dumps({"actions": actions}))
+
+    @classmethod
+    def get_features_for_disease(cls, idx, idx_type, disease, size=100, search_from=0):
+        ''' function to get the criteria hits of the features tagged with a disease ordered by score, from the
+            disease partition (see get_disease_idx)
+        @type  idx: string
+        @param idx: name of the index
+        @type  idx_type: string
+        @param idx_type: comma separated idx types, each criteria is an index type
+        @type  disease: string
+        @param disease: disease code eg: T1D
+        '''
+        query = ElasticQuery.filtered_bool(Query.match_all(), cls.get_disease_filter([disease]),
+                                           sources=['qid', 'score', 'disease_tags', cls.ALL_DISEASES])
+        search = Search(query, idx=cls.get_disease_idx(idx, disease, idx_type), idx_type=idx_type, size=size,
+                        search_from=search_from, qsort=Sort('-score'))
+        return search.get_json_response()['hits']
+
+    @classmethod
+    def get_links_doc(cls, doc):
+        ''' function to convert a criteria document to the links layout, where the criteria dicts of all the
+            diseases are in one links list with a disease field, eg: {'links': [{'disease': 'T1D',
+            'fid': 'GDXHsS00004', 'fname': 'Barrett'}], 'disease_tags': ['T1D'], ...}
+        @type  doc: dict
+        @param doc: criteria document (see get_criteria_doc)
+        '''
+        links = []
+        for disease in doc['disease_tags']:
+            for criteria_dict in doc.pop(disease, []):
+                link = dict(criteria_dict)
+                link['disease'] = disease
+                links.append(link)
+        doc['links'] = links
+        return doc
+
+    @classmethod
+    def get_criteria_source(cls, source):
+        ''' function to convert the _source of a criteria document in the links layout or with the all_diseases
+            flag to the dict with keys as disease code and values as the list of criteria dicts, returns the _source
+        @type  source: dict
+        @param source: _source of a criteria document
+        '''
+        for link in source.pop('links', []):
+            criteria_dict = dict(link)
+            disease = criteria_dict.pop('disease')
+            source.setdefault(disease, []).append(criteria_dict)
+        return cls.expand_all_diseases(source)
+
+    @classmethod
+    def build_rollup(cls, feature, config=None):
+        ''' Build stage run after all the criteria of a feature type are built. Scans all the criteria index types
+            of the feature and loads one rollup document per feature (the ROLLUP_TYPE idx type of the rollup index,
+            see get_rollup_idx) with the union of the disease tags, the disease tags of each criteria and the total
+            score, so that the disease tags of a feature are read with one GET (see get_rollup).
+        @type  feature: string
+        @param feature: feature type, could be 'gene','region', 'marker' etc.,
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        '''
+        if config is None:
+            config = CriteriaManager.get_criteria_config()
+        criteria_idx = cls.get_criteria_idx(feature, config)
+        criteria_types = cls.get_available_criterias(feature, config).get(feature, [])
+        if len(criteria_types) == 0:
+            return
+
+        rollups = {}
+
+        def process_hits(resp_json):
+            for hit in resp_json['hits']['hits']:
+                cls.add_to_rollup(rollups, hit)
+
+        query = ElasticQuery(Query.match_all(), sources=['qid', 'disease_tags', 'score', cls.ALL_DISEASES])
+        ScanAndScroll.scan_and_scroll(criteria_idx + '/' + ','.join(criteria_types), call_fun=process_hits,
+                                      query=query)
+
+        rollup_idx = cls.get_rollup_idx(criteria_idx)
+        cls.create_rollup_mapping(rollup_idx, criteria_types)
+        loader = CriteriaBulkLoader(rollup_idx, cls.ROLLUP_TYPE)
+        for qid, rollup in rollups.items():
+            loader.add(qid, rollup)
+        loader.close()
+        logger.warning(rollup_idx + ' ' + cls.ROLLUP_TYPE + ' loaded ' + str(len(rollups)) + ' features. DONE')
+
+    @classmethod
+    def drop_rollup(cls, feature, config=None):
+        ''' function to delete the rollup index of a feature type before any of its criteria are rebuilt. The
+            disease tags are then read from the criteria index types until the rollup is built again after a full
+            build of the feature (see CriteriaManager.process_criterias).
+        @type  feature: string
+        @param feature: feature type, could be 'gene','region', 'marker' etc.,
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        '''
+        if config is None:
+            config = CriteriaManager.get_criteria_config()
+        rollup_idx = cls.get_rollup_idx(cls.get_criteria_idx(feature, config))
+        response = requests.delete(ElasticSettings.url() + '/' + rollup_idx)
+        if response.status_code == 200:
+            logger.warning(rollup_idx + ' dropped until the next full build of the ' + feature + ' criteria')
+
+    @classmethod
+    def get_rollup_idx(cls, idx):
+        ''' function to get the name of the rollup index of a criteria index '''
+        return idx + '_rollup'
+
+    @classmethod
+    def add_to_rollup(cls, rollups, hit):
+        ''' function to add the disease tags and score of a criteria hit to the rollup of its feature
+        @type  rollups: dict
+        @param rollups: feature id => rollup document
+        @type  hit: dict
+        @param hit: criteria index hit with qid, disease_tags and score in the _source
+        '''
+        source = cls.expand_all_diseases(hit['_source'])
+        qid = source['qid']
+        rollup = rollups.setdefault(qid, {'qid': qid, 'disease_tags': [], 'criteria': {}, 'score': 0})
+        rollup['criteria'][hit['_type']] = source['disease_tags']
+        rollup['score'] += source.get('score', 0)
+        for disease in source['disease_tags']:
+            if disease not in rollup['disease_tags']:
+                rollup['disease_tags'].append(disease)
+        return rollups
+
+    @classmethod
+    def create_rollup_mapping(cls, idx, criteria_types):
+        ''' function to create the mapping of the rollup idx type in the rollup index '''
+        props = MappingProperties(cls.ROLLUP_TYPE)
+        props.add_property("qid", "string", index="not_analyzed")
+        props.add_property("disease_tags", "string", index="not_analyzed")
+        props.add_property("score", "integer")
+        criteria_props = MappingProperties('criteria')
+        for criteria in criteria_types:
+            criteria_props.add_property(criteria, "string", index="not_analyzed")
+        props.add_properties(criteria_props)
+
+        meta = {"desc": "Disease tags of all the criteria of a feature"}
+        Loader().mapping(props, cls.ROLLUP_TYPE, meta=meta, analyzer=Loader.KEYWORD_ANALYZER, indexName=idx,
+                         shards=5)
+        return props
+
+    @classmethod
+    def get_rollup(cls, idx, feature_id):
+        ''' function to get the rollup document of a feature with a GET by id, or None if there is none
+        @type  idx: string
+        @param idx: name of the criteria index
+        @type  feature_id: string
+        @param feature_id: Id of the feature (gene => gene_id, region=>region_id)
+        '''
+        if idx is None or ',' in idx:
+            return None
+        try:
+            response = Search.elastic_request(ElasticSettings.url(),
+                                              cls.get_rollup_idx(idx) + '/' + cls.ROLLUP_TYPE + '/' + feature_id,
+                                              is_post=False)
+            doc = response.json()
+            if doc.get('found'):
+                return doc['_source']
+        except:
+            pass
+        return None
+
+    @classmethod
+    def get_rollups(cls, idx, feature_ids):
+        ''' function to get the rollup documents of features with one multi get, returns a dict of feature id =>
+            rollup document for the features that have one
+        @type  idx: string
+        @param idx: name of the index
+        @type  feature_ids: list
+        @param feature_ids: Ids of the features (gene => gene_id, region=>region_id)
+        '''
+        if idx is None or ',' in idx or len(feature_ids) == 0:
+            return {}
+        try:
+            response = Search.elastic_request(ElasticSettings.url(),
+                                              cls.get_rollup_idx(idx) + '/' + cls.ROLLUP_TYPE + '/_mget',
+                                              data=json.dumps({'ids': list(feature_ids)}))
+            return {doc['_id']: doc['_source'] for doc in response.json().get('docs', []) if doc.get('found')}
+        except:
+            return {}
+
+    @classmethod
+    def get_rollup_disease_tags(cls, rollup, idx_type=None):
+        ''' function to get the disease tags of a rollup document for the comma separated idx types, or for
+            all the criteria if idx_type is None
+        '''
+        if not idx_type:
+            return rollup['disease_tags']
+
+        disease_tags = []
+        for criteria in idx_type.split(','):
+            for disease in rollup['criteria'].get(criteria.strip(), []):
+                if disease not in disease_tags:
+                    disease_tags.append(disease)
+        return disease_tags
+
+    @classmethod
+    def get_disease_filter(cls, diseases, match_all=False):
+        ''' function to get a filter for the features tagged with any (or all) of diseases, with term filters on
+            disease_tags (cached by elastic) or the all_diseases flag
+        @type  diseases: list
+        @param diseases: list of disease codes eg: ['T1D', 'MS']
+        @type  match_all: boolean
+        @keyword match_all: True for the features tagged with all the diseases
+        '''
+        query_bool = BoolQuery()
+        if match_all:
+            tags_bool = BoolQuery()
+            for disease in diseases:
+                tags_bool.must(Query.term("disease_tags", disease.upper()))
+            query_bool.should(tags_bool)
+        else:
+            query_bool.should(Query.terms("disease_tags", [disease.upper() for disease in diseases]))
+        return query_bool.should(Query.term(cls.ALL_DISEASES, True))
+
+    @classmethod
+    def count_features_by_diseases(cls, idx, idx_type, diseases, match_all=False):
+        ''' function to count the features of a criteria index type tagged with any (or all) of diseases
+        @type  idx: string
+        @param idx: name of the index
+        @type  idx_type: string
+        @param idx_type: name of the idx type, each criteria is an index type
+        @type  diseases: list
+        @param diseases: list of disease codes eg: ['T1D', 'MS']
+        @type  match_all: boolean
+        @keyword match_all: True to count the features tagged with all the diseases
+        '''
+        if len(diseases) == 1 or match_all:
+            # the features tagged with all the diseases are all in the partition of any one of them
+            idx = cls.get_disease_idx(idx, diseases[0], idx_type)
+        query = ElasticQuery.filtered_bool(Query.match_all(), cls.get_disease_filter(diseases, match_all=match_all))
+        search = Search(query, idx=idx, idx_type=idx_type, size=0)
+        return search.get_json_response()['hits']['total']
+
+    @classmethod
+    def expand_all_diseases(cls, source):
+        ''' function to expand the _source of a criteria document with the all_diseases flag in to the entry
+            per disease and the disease_tags of the site diseases, returns the _source
+        @type  source: dict
+        @param source: _source of a criteria document
+        '''
+        if source.get(cls.ALL_DISEASES):
+            disease_tags = source.setdefault('disease_tags', [])
+            for disease in cls.site_enabled_diseases:
+                if disease not in disease_tags:
+                    disease_tags.append(disease)
+                source.setdefault(disease, [{'fid': disease, 'fname': disease}])
+        return source
 
     @classmethod
     def populate_container(cls, fid, fname, fnotes=None, features=None, diseases=None, result_container={}):
@@ -471,30 +1590,24 @@ class Criteria():
 
         result_container_ = result_container
 
+        if isinstance(result_container_, (CompactResultContainer, DiskResultContainer)):
+            result_container_.add(fid, fname, fnotes=fnotes, features=features, diseases=diseases)
+            return result_container_
+
         criteria_dict = cls.get_criteria_dict(fid, fname, fnotes)
 
-        dis_dict = dict()
-        criteria_disease_dict = {}
+        diseases = list(diseases)
+        if len(diseases) == 0:
+            return result_container_
+
         for feature in features:
 
             if feature is None:
                 continue
 
-            for disease in diseases:
-
-                dis_dict[disease] = []
-                if len(result_container_.get(feature, {})) > 0:
-
-                    criteria_disease_dict = result_container_[feature]
-                    criteria_disease_dict = cls.get_criteria_disease_dict(diseases, criteria_dict,
-                                                                          criteria_disease_dict)
-
-                    result_container_[feature] = criteria_disease_dict
-                else:
-                    criteria_disease_dict = {}
-                    criteria_disease_dict = cls.get_criteria_disease_dict(diseases, criteria_dict,
-                                                                          criteria_disease_dict)
-                    result_container_[feature] = criteria_disease_dict
+            criteria_disease_dict = result_container_.get(feature, {})
+            result_container_[feature] = cls.get_criteria_disease_dict(diseases, criteria_dict,
+                                                                       criteria_disease_dict)
 
         return result_container_
 
@@ -542,22 +1655,29 @@ class Criteria():
         @type  idx_type: string
         @param idx_type: name of the idx type, each criteria is an index type
         '''
-        query = ElasticQuery(Query.term("qid", feature_id))
-        agg = Agg("criteria_disease_tags", "terms", {"field": "disease_tags", "size": 0})
-        aggs = Aggs(agg)
-
-        if idx_type:
-            search = Search(query, aggs=aggs, idx=idx, idx_type=idx_type)
+        rollup = cls.get_rollup(idx, feature_id)
+        if rollup is not None:
+            disease_tags = [disease.lower() for disease in cls.get_rollup_disease_tags(rollup, idx_type)]
         else:
-            search = Search(query, aggs=aggs, idx=idx)
+            query = ElasticQuery(Query.term("qid", feature_id), sources=[cls.ALL_DISEASES])
+            agg = Agg("criteria_disease_tags", "terms", {"field": "disease_tags", "size": 0})
+            aggs = Aggs(agg)
 
-        disease_tags = []
-        try:
-            r_aggs = search.search().aggs
-            buckets = r_aggs['criteria_disease_tags'].get_buckets()
-            disease_tags = [dis_dict['key'].lower() for dis_dict in buckets]
-        except:
-            return []
+            if idx_type:
+                search = Search(query, aggs=aggs, idx=idx, idx_type=idx_type)
+            else:
+                search = Search(query, aggs=aggs, idx=idx)
+
+            disease_tags = []
+            try:
+                result = search.search()
+                buckets = result.aggs['criteria_disease_tags'].get_buckets()
+                disease_tags = [dis_dict['key'].lower() for dis_dict in buckets]
+            except:
+                return []
+
+            if any(getattr(doc, cls.ALL_DISEASES, False) for doc in result.docs):
+                disease_tags = [disease.lower() for disease in cls.site_enabled_diseases]
 
         # get disease docs
         if (len(disease_tags) > 0):
@@ -585,16 +1705,27 @@ class Criteria():
         search = Search(query, idx=idx, idx_type=idx_type)
 #        elastic_docs = search.search().docs
         criteria_hits = search.get_json_response()['hits']
+        for hit in criteria_hits['hits']:
+            cls.get_criteria_source(hit['_source'])
         return(criteria_hits)
 
     @classmethod
     def get_all_criteria_disease_tags(cls, qids, idx, idx_type):
 
+        rollup_disease_tags = {}
+        if qids is not None:
+            rollups = cls.get_rollups(idx, qids)
+            rollup_disease_tags = cls.get_criteria_disease_tags_from_rollups(idx, idx_type, rollups)
+            # features without a rollup are read from the criteria index types
+            qids = [qid for qid in qids if qid not in rollups]
+            if len(qids) == 0:
+                return rollup_disease_tags
+
         if qids is None:
-            query = ElasticQuery(Query.match_all(), sources=['disease_tags', 'qid'])
+            query = ElasticQuery(Query.match_all(), sources=['disease_tags', 'qid', cls.ALL_DISEASES])
             # search = Search(query, idx=idx, idx_type=idx_type, size=30000)
         else:
-            query = ElasticQuery(Query.terms("qid", qids), sources=['disease_tags', 'qid'])
+            query = ElasticQuery(Query.terms("qid", qids), sources=['disease_tags', 'qid', cls.ALL_DISEASES])
             # search = Search(query, idx=idx, idx_type=idx_type)
 
         search = Search(query, idx=idx, idx_type=idx_type)
@@ -614,7 +1745,7 @@ class Criteria():
 
                 if qid not in criteria_disease_tags:
                     criteria_disease_tags[qid] = {}
-                criteria_disease_tags[qid][criteria_desc] = hit['_source']['disease_tags']
+                criteria_disease_tags[qid][criteria_desc] = cls.expand_all_diseases(hit['_source'])['disease_tags']
 
         disease_tags_all = []
         for fid, fvalue in criteria_disease_tags.items():
@@ -623,8 +1754,45 @@ class Criteria():
 
             criteria_disease_tags[fid]['meta_info'] = meta_info
 
+        criteria_disease_tags.update(rollup_disease_tags)
         return(criteria_disease_tags)
 
+    @classmethod
+    def get_criteria_disease_tags_from_rollups(cls, idx, idx_type, rollups):
+        ''' function to get the disease tags of each criteria and of all the criteria (all) for features from
+            their rollup documents, in the same form as get_all_criteria_disease_tags
+        @type  idx: string
+        @param idx: name of the index
+        @type  idx_type: string
+        @param idx_type: comma separated idx types, each criteria is an index type
+        @type  rollups: dict
+        @param rollups: feature id => rollup document (see get_rollups)
+        '''
+        criteria_types = None
+        if idx_type:
+            criteria_types = [criteria.strip() for criteria in idx_type.split(',')]
+
+        meta_info = {}
+        criteria_disease_tags = {}
+        for qid, rollup in rollups.items():
+            criteria_tags = {criteria: disease_tags for criteria, disease_tags in rollup['criteria'].items()
+                             if criteria_types is None or criteria in criteria_types}
+            if len(criteria_tags) == 0:
+                continue
+
+            for criteria in criteria_tags:
+                if criteria not in meta_info:
+                    meta_desc = cls.get_meta_desc(idx, [criteria])
+                    if idx in meta_desc:
+                        meta_info[criteria] = meta_desc[idx][criteria]
+
+            criteria_disease_tags[qid] = dict(criteria_tags)
+            criteria_disease_tags[qid]['all'] = cls.get_rollup_disease_tags(rollup, idx_type)
+
+        for qid in criteria_disease_tags:
+            criteria_disease_tags[qid]['meta_info'] = meta_info
+        return criteria_disease_tags
+
     @classmethod
     def get_all_criteria_disease_tags_aggregated(cls, qid, criteria_disease_tags):
 
@@ -4,6 +4,8 @@ import os
 from builtins import classmethod
 from disease import utils
 import datetime
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pydgin_auth.elastic_model_factory import ElasticPermissionModelFactory as elastic_factory
 
 # Get an instance of a logger
@@ -45,51 +47,183 @@ class CriteriaManager():
             return (main_codes, other_codes)
 
     @classmethod
-    def process_criterias(cls, feature, criteria=None, config=None, show=False, test=False):
-        '''function to delegate the call to the right criteria class and build the criteria for that class
+    def get_criteria_class(cls, feature):
+        '''function to get the criteria class that implements the criterias for a given feature type
         '''
-        from criteria.helper.criteria import Criteria
         from criteria.helper.gene_criteria import GeneCriteria
         from criteria.helper.marker_criteria import MarkerCriteria
         from criteria.helper.region_criteria import RegionCriteria
         from criteria.helper.study_criteria import StudyCriteria
 
+        criteria_classes = {'gene': GeneCriteria,
+                            'marker': MarkerCriteria,
+                            'region': RegionCriteria,
+                            'study': StudyCriteria}
+        return criteria_classes.get(feature)
+
+    @classmethod
+    def process_criterias(cls, feature, criteria=None, config=None, show=False, test=False, workers=1,
+                          slices=None, shared_scan=False):
+        '''function to delegate the call to the right criteria class and build the criteria for that class.
+        feature can be a comma separated list of feature types (eg: gene,marker) to build together.
+        With workers > 1 the sections are built at the same time in a pool of worker processes, each with
+        its own result container and bulk loader. With slices > 1 the scan of each section's source index
+        is split in to slices that are scanned at the same time (see L{Criteria.scan_slices}). With shared_scan
+        the sections with the same source index and type are built from one scan (see L{plan_shared_scans}).
+        '''
+        from criteria.helper.criteria import Criteria
+
         if config is None:
             if test:
                 config = cls.get_criteria_config(ini_file='test_criteria.ini')
             else:
                 config = cls.get_criteria_config(ini_file='criteria.ini')
 
-        available_criterias = Criteria.get_available_criterias(feature, config=config, test=test)[feature]
-
-        criterias_to_process = []
-        if criteria is None:
-            criterias_to_process = available_criterias
-        else:
-            criterias_list = criteria.split(',')
-            criterias_to_process = [criteria.strip() for criteria in criterias_list
-                                    if criteria.strip() in available_criterias]
+        features = [feature_type.strip() for feature_type in feature.split(',')]
+        feature_sections = []
+        feature_criterias = {}
+        for feature_type in features:
+            available_criterias = Criteria.get_available_criterias(feature_type, config=config,
+                                                                   test=test)[feature_type]
+            feature_criterias[feature_type] = available_criterias
+            if criteria is None:
+                criterias_to_process = available_criterias
+            else:
+                criterias_list = criteria.split(',')
+                criterias_to_process = [criteria.strip() for criteria in criterias_list
+                                        if criteria.strip() in available_criterias]
+            feature_sections.extend((feature_type, section) for section in criterias_to_process)
 
+        criterias_to_process = [section for (feature_type, section) in feature_sections]
         if show:
             print(criterias_to_process)
             return criterias_to_process
 
-        logger.debug(datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'))
-        for section in criterias_to_process:
-            if feature == 'gene':
-                print('Call to build criteria gene index')
-                Criteria.process_criteria(feature, section, config, GeneCriteria, test=test)
-            elif feature == 'marker':
-                print('Call to build criteria marker index')
-                Criteria.process_criteria(feature, section, config, MarkerCriteria, test=test)
-            elif feature == 'region':
-                print('Call to build criteria region index')
-                Criteria.process_criteria(feature, section, config, RegionCriteria, test=test)
-            elif feature == 'study':
-                print('Call to build criteria study index')
-                Criteria.process_criteria(feature, section, config, StudyCriteria, test=test)
-            else:
+        for feature_type in features:
+            if cls.get_criteria_class(feature_type) is None:
                 logger.critical('Unsupported feature ... please check the inputs')
+                return
+
+        if shared_scan and not test:
+            scan_groups = cls.plan_shared_scans(feature_sections, config)
+        else:
+            scan_groups = [[feature_section] for feature_section in feature_sections]
 
+        logger.debug(datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'))
+        if not test:
+            # the rollup of a feature is stale as soon as any of its criteria is rebuilt
+            for feature_type in features:
+                Criteria.drop_rollup(feature_type, config)
+
+        Criteria.reset_build_caches()
+        build_start = time.time()
+        if workers is not None and workers > 1 and len(scan_groups) > 1:
+            section_times = cls.process_criterias_parallel(scan_groups, config, test=test, workers=workers,
+                                                           slices=slices)
+        else:
+            section_times = {}
+            for scan_group in scan_groups:
+                print('Call to build criteria ' + ', '.join(section for (feature_type, section) in scan_group))
+                for (section, wall_time) in cls.process_scan_group(scan_group, config, test=test, slices=slices):
+                    section_times[section] = wall_time
+
+        if not test:
+            # rollup of the disease tags of all the criteria of each feature, once all of them have been built
+            for feature_type in features:
+                if all(section in section_times for section in feature_criterias[feature_type]):
+                    Criteria.build_rollup(feature_type, config)
+                else:
+                    logger.warning('No rollup for ' + feature_type + ' as not all of its criteria were built')
+
+        cls.show_section_times(criterias_to_process, section_times, time.time() - build_start)
         logger.debug(datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'))
         logger.debug('========DONE==========')
+        return section_times
+
+    @classmethod
+    def plan_shared_scans(cls, feature_sections, config):
+        '''function to group the sections to build by (source_idx, source_idx_type) so that each source is scanned
+        once for all of its sections. Sections with their own query (the MHC criterias and
+        marker_is_gwas_significant_in_ic) or their own scan (scan_slices, stream_load, flush_pages) are built on
+        their own.
+        Returns a list of scan groups, each a list of (feature, section).
+        '''
+        scan_groups = {}
+        for (feature, section) in feature_sections:
+            section_config = config[section]
+            if ('mhc' in section or section == 'marker_is_gwas_significant_in_ic' or
+                    int(section_config.get('scan_slices', 1)) > 1 or
+                    section_config.getboolean('stream_load', False) or
+                    int(section_config.get('flush_pages', 0)) > 0 or
+                    section_config.getboolean('prefetch_meta', False)):
+                scan_key = (feature, section)
+            else:
+                scan_key = (section_config['source_idx'].strip(), section_config.get('source_idx_type', '').strip())
+            scan_groups.setdefault(scan_key, []).append((feature, section))
+        return list(scan_groups.values())
+
+    @classmethod
+    def process_scan_group(cls, scan_group, config, test=False, slices=None):
+        '''function to build the sections of a scan group, from one shared scan if there is more than one section,
+        returns a list of (section, wall time in seconds)
+        '''
+        from criteria.helper.criteria import Criteria
+        if len(scan_group) == 1:
+            (feature, section) = scan_group[0]
+            return [cls.process_section(feature, section, config, cls.get_criteria_class(feature), test=test,
+                                        slices=slices)]
+
+        start = time.time()
+        Criteria.process_criteria_shared([(feature, section, cls.get_criteria_class(feature))
+                                          for (feature, section) in scan_group], config)
+        wall_time = time.time() - start
+        return [(section, wall_time) for (feature, section) in scan_group]
+
+    @classmethod
+    def process_section(cls, feature, section, config, sub_class, test=False, slices=None):
+        '''function to build a single criteria section, returns the section name and its wall time in seconds
+        '''
+        from criteria.helper.criteria import Criteria
+        start = time.time()
+        Criteria.process_criteria(feature, section, config, sub_class, test=test, slices=slices)
+        return (section, time.time() - start)
+
+    @classmethod
+    def process_criterias_parallel(cls, scan_groups, config, test=False, workers=2, slices=None):
+        '''function to build independent scan groups (see L{plan_shared_scans}) at the same time in a process
+        pool. The mappings are created up front so that the workers do not race to create the criteria index.
+        Returns a dict with the wall time of each section that completed.
+        '''
+        from criteria.helper.criteria import Criteria
+
+        for scan_group in scan_groups:
+            for (feature, section) in scan_group:
+                Criteria.create_criteria_mapping(Criteria.get_criteria_idx(feature, config), section)
+
+        section_times = {}
+        print('Call to build ' + str(len(scan_groups)) + ' criteria scans with ' + str(workers) + ' workers')
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(cls.process_scan_group, scan_group, config, test, slices): scan_group
+                       for scan_group in scan_groups}
+            for future in as_completed(futures):
+                sections = ', '.join(section for (feature, section) in futures[future])
+                try:
+                    for (section, wall_time) in future.result():
+                        section_times[section] = wall_time
+                except Exception as e:
+                    logger.critical('Failed to build criteria ' + sections + ': ' + str(e))
+
+        return section_times
+
+    @classmethod
+    def show_section_times(cls, sections, section_times, total_time):
+        '''function to print a summary of the wall time spent on each criteria section
+        '''
+        print('')
+        print('Criteria build times (wall time in seconds):')
+        for section in sections:
+            if section in section_times:
+                print('  %-40s %10.1f' % (section, section_times[section]))
+            else:
+                print('  %-40s %10s' % (section, 'FAILED'))
+        print('  %-40s %10.1f' % ('total', total_time))
@@ -1,9 +1,11 @@
 import logging
+import sys
 from builtins import classmethod
-from elastic.search import ElasticQuery, Search
-from elastic.query import Query, BoolQuery
+from elastic.search import ElasticQuery, Search, ScanAndScroll
+from elastic.query import Query
 from elastic.elastic_settings import ElasticSettings
-from criteria.helper.criteria import Criteria
+from criteria.helper.criteria import Criteria, criteria_fields
+from criteria.helper.interval_index import IntervalIndex
 from region import utils
 from elastic.result import Document
 from criteria.helper.criteria_manager import CriteriaManager
@@ -19,6 +21,7 @@ class GeneCriteria(Criteria):
     FEATURE_TYPE = 'gene'
 
     @classmethod
+    @criteria_fields('study_id', 'genes', 'diseases', 'authors')
     def cand_gene_in_study(cls, hit, section=None, config=None, result_container={}):
         '''function that implements the cand_gene_in_study criteria
         '''
@@ -42,6 +45,7 @@ class GeneCriteria(Criteria):
         return result_container_populated
 
     @classmethod
+    @criteria_fields('disease_locus', 'genes', 'disease', 'status')
     def cand_gene_in_region(cls, hit, section=None, config=None, result_container={}):
         '''function that implements the cand_gene_in_region criteria
         '''
@@ -87,8 +91,8 @@ class GeneCriteria(Criteria):
             start = getattr(gene_doc, "start")
             stop = getattr(gene_doc, "stop")
             # check if they overlap a region
-            overlapping_region_docs = cls.fetch_overlapping_features(build, seqid, start, stop,
-                                                                     idx=region_idx, idx_type=region_idx_type)
+            overlapping_region_docs = cls.get_overlapping_features(build, seqid, start, stop,
+                                                                   idx=region_idx, idx_type=region_idx_type)
 
             region_docs = utils.Region.hits_to_regions(overlapping_region_docs)
 
@@ -129,6 +133,7 @@ class GeneCriteria(Criteria):
 
     @classmethod
     def gene_in_region(cls, hit, section=None, config=None, result_container={}):
+        # not declared with criteria_fields as pad_region_doc reads the other fields of the region (disease_loci)
 
         try:
             padded_region_doc = utils.Region.pad_region_doc(Document(hit))
@@ -146,15 +151,19 @@ class GeneCriteria(Criteria):
         end = build_info['end']
 
         gene_index = ElasticSettings.idx('GENE', idx_type='GENE')
-        elastic = Search.range_overlap_query(seqid=seqid, start_range=start, end_range=end,
-                                             idx=gene_index, field_list=['start', 'stop', '_id'],
-                                             seqid_param="chromosome",
-                                             end_param="stop", size=10000)
-        result_docs = elastic.search().docs
+        gene_coordinates = cls.get_gene_coordinate_index(gene_index)
 
         genes = set()
-        for doc in result_docs:
-            genes.add(doc.doc_id())
+        if gene_coordinates is not None:
+            genes.update(gene_coordinates.overlaps(str(seqid), start, end))
+        else:
+            elastic = Search.range_overlap_query(seqid=seqid, start_range=start, end_range=end,
+                                                 idx=gene_index, field_list=['start', 'stop', '_id'],
+                                                 seqid_param="chromosome",
+                                                 end_param="stop", size=10000)
+            result_docs = elastic.search().docs
+            for doc in result_docs:
+                genes.add(doc.doc_id())
 
         result_container_populated = cls.populate_container(region_id,
                                                             region_name,
@@ -164,6 +173,37 @@ class GeneCriteria(Criteria):
         return result_container_populated
 
     @classmethod
+    def get_gene_coordinate_index(cls, gene_index):
+        '''function to get the gene coordinates (chromosome, start, stop, id) in per-chromosome sorted arrays,
+        loaded with a scan of the gene index the first time it is used in a build. Returns None if the genes
+        can not be loaded.
+        '''
+        cache_key = ('gene_coordinate_index', gene_index)
+        if cache_key in Criteria.build_caches:
+            return Criteria.build_caches[cache_key]
+
+        gene_coordinates = IntervalIndex()
+
+        def add_hits(resp_json):
+            for hit in resp_json['hits']['hits']:
+                gene_doc = hit['_source']
+                if 'chromosome' in gene_doc and 'start' in gene_doc and 'stop' in gene_doc:
+                    gene_coordinates.add(str(gene_doc['chromosome']), gene_doc['start'], gene_doc['stop'],
+                                         sys.intern(hit['_id']))
+
+        query = ElasticQuery(Query.match_all(), sources=['chromosome', 'start', 'stop'])
+        try:
+            ScanAndScroll.scan_and_scroll(gene_index, call_fun=add_hits, query=query)
+            logger.warning('Loaded coordinates of ' + str(len(gene_coordinates)) + ' genes from ' + gene_index)
+        except Exception as e:
+            logger.warning('Unable to load gene coordinates from ' + gene_index + ': ' + str(e))
+            gene_coordinates = None
+
+        Criteria.build_caches[cache_key] = gene_coordinates
+        return gene_coordinates
+
+    @classmethod
+    @criteria_fields('marker', 'disease', 'status', 'disease_locus', 'dil_study_id')
     def exonic_index_snp_in_gene(cls, hit, section=None, config=None, result_container={}):
 
         feature_doc = hit['_source']
@@ -193,17 +233,60 @@ class GeneCriteria(Criteria):
             return result_container
 
         # get marker info and gene info from function info dbsp
-        # get marker doc
-        query = ElasticQuery(BoolQuery(must_arr=[Query.term("id", marker)]), sources=['id', 'info'])
-        elastic = Search(search_query=query, idx=ElasticSettings.idx('MARKER', 'MARKER'), size=1)
-        docs = elastic.search().docs
-        marker_doc = None
+        ensembl_gene_ids = cls.get_exonic_gene_ids(marker)
+        if ensembl_gene_ids is None:
+            return result_container
+
+        dil_study_id = feature_doc['dil_study_id']
+        fnotes = None
+        if dil_study_id:
+            first_author = cls.get_first_author(dil_study_id)
+            fnotes = {'linkid': dil_study_id, 'linkname': first_author}
+
+        result_container_populated = cls.populate_container(marker,
+                                                            marker,
+                                                            fnotes=fnotes, features=ensembl_gene_ids,
+                                                            diseases=[disease],
+                                                            result_container=result_container)
 
-        if docs is not None and len(docs) > 0:
-            marker_doc = elastic.search().docs[0]
+        return result_container_populated
 
+    @classmethod
+    def exonic_index_snp_in_gene_prefetch(cls, hits, section=None, config=None):
+        '''function to fetch the marker docs of all the index snps of a scroll page with one terms query'''
+        markers = set()
+        for hit in hits:
+            feature_doc = hit['_source']
+            if feature_doc.get('marker') is None or feature_doc.get('disease') is None:
+                continue
+            if feature_doc.get('status') != 'N' or feature_doc.get('disease_locus', '').lower() == 'tbc':
+                continue
+            markers.add(feature_doc['marker'])
+        cls.get_marker_docs(markers)
+
+    @classmethod
+    def get_marker_docs(cls, markers, batch_size=1000):
+        '''function to get the marker docs for a list of markers with terms queries of up to batch_size markers
+        (see Criteria.get_docs_by_ids), returns a dict of marker => doc (None if the marker is not found).
+        '''
+        marker_docs = cls.get_docs_by_ids(ElasticSettings.idx('MARKER', 'MARKER'), list(markers),
+                                          sources=Criteria.MARKER_SOURCES, batch_size=batch_size, field='id')
+        return {marker: marker_docs.get(marker) for marker in markers}
+
+    @classmethod
+    def get_exonic_gene_ids(cls, marker):
+        '''function to get the ensembl ids of the genes of an exonic marker, or None if the marker is not found
+        or is not exonic. The functional info decoded from the marker doc is kept for the rest of the build.
+        '''
+        exonic_gene_ids = Criteria.build_caches.setdefault('exonic_gene_ids', {})
+        Criteria.count_lookup('exonic_gene_ids', hit=marker in exonic_gene_ids)
+        if marker in exonic_gene_ids:
+            return exonic_gene_ids[marker]
+
+        marker_doc = cls.get_marker_docs([marker])[marker]
         if marker_doc is None:
-            return result_container
+            exonic_gene_ids[marker] = None
+            return None
 
         from marker.templatetags.marker_tags import marker_functional_info
         from marker.templatetags.marker_tags import gene_info
@@ -215,44 +298,15 @@ class GeneCriteria(Criteria):
         ('has non-synonymous missense', False), ('has non-synonymous frameshift', False), ('has stop loss', False)])
         '''
         functional_info = marker_functional_info(marker_doc)
-        # print(functional_info)
-
-        is_in_exon = False
 
         if functional_info['has non-synonymous missense'] or\
             functional_info['has synonymous'] or functional_info['has non-synonymous frameshift'] or\
             functional_info['has reference'] or functional_info['has stop gain'] or\
                 functional_info['has stop loss']:
-                is_in_exon = True
-
-        # gene_symbols = []
-        if is_in_exon:
-            gene_ids = gene_info(marker_doc)
-            ensembl_gene_ids = gene_ids.values()
-#             gene_symbols.extend(list(gene_ids.keys()))
-#             print(ensembl_gene_ids)
-#             for gene in gene_symbols:
-#                 print('^^^\t'+gene)
+            exonic_gene_ids[marker] = list(gene_info(marker_doc).values())
         else:
-            return result_container
-
-        dil_study_id = feature_doc['dil_study_id']
-        fnotes = None
-        if dil_study_id:
-            query = ElasticQuery(Query.ids([dil_study_id]))
-            elastic = Search(search_query=query, idx=ElasticSettings.idx('STUDY', 'STUDY'), size=1)
-            study_doc = elastic.search().docs[0]
-            author = getattr(study_doc, 'authors')[0]
-            first_author = author['name'] + ' ' + author['initials']
-            fnotes = {'linkid': dil_study_id, 'linkname': first_author}
-
-        result_container_populated = cls.populate_container(marker,
-                                                            marker,
-                                                            fnotes=fnotes, features=ensembl_gene_ids,
-                                                            diseases=[disease],
-                                                            result_container=result_container)
-
-        return result_container_populated
+            exonic_gene_ids[marker] = None
+        return exonic_gene_ids[marker]
 
     @classmethod
     def fetch_disease_locus(cls, hits_docs):
@@ -309,6 +363,17 @@ class GeneCriteria(Criteria):
         criteria_disease_tags = Criteria.get_all_criteria_disease_tags(qids, idx, idx_type)
         return(criteria_disease_tags)
 
+    @classmethod
+    def get_genes_for_disease(cls, disease, idx_type=None, size=100, search_from=0):
+        '''Function to get the criteria hits of the genes tagged with a disease, ordered by score. Searches the
+        disease partition of the gene criteria index (see Criteria.get_disease_idx)'''
+        (idx, idx_types) = cls.get_feature_idx_n_idxtypes(cls.FEATURE_TYPE)
+
+        if idx_type is None:
+            idx_type = idx_types
+
+        return Criteria.get_features_for_disease(idx, idx_type, disease, size=size, search_from=search_from)
+
     @classmethod
     def get_disease_codes_from_results(cls, criteria_results):
         idx = ElasticSettings.idx(cls.FEATURE_TYPE.upper()+'_CRITERIA')
@@ -0,0 +1,75 @@
+from array import array
+from bisect import bisect_right
+
+
+class IntervalIndex():
+    ''' In-memory index of intervals for overlap lookups. Intervals are grouped by a key (eg: build and seqid)
+    and kept in compact arrays sorted by start. An overlap query is a binary search on the starts, bounded by
+    the longest interval for the key, followed by a check on the ends.
+    '''
+
+    def __init__(self):
+        self._pending = {}
+        self._starts = {}
+        self._ends = {}
+        self._values = {}
+        self._max_length = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, key, start, end, value):
+        ''' Add an interval and the value to return when a query overlaps it.
+        @type  key: string
+        @param key: key to group the intervals by eg: ('38', '1')
+        @type  start: integer
+        @param start: interval start
+        @type  end: integer
+        @param end: interval end
+        @param value: value returned for overlapping queries
+        '''
+        start = int(start)
+        end = int(end)
+        if end < start:
+            (start, end) = (end, start)
+        self._pending.setdefault(key, []).append((start, end, value))
+        self._size += 1
+
+    def _build(self, key):
+        ''' Merge any intervals added for the key in to its sorted arrays. '''
+        intervals = self._pending.pop(key)
+        if key in self._starts:
+            intervals.extend(zip(self._starts[key], self._ends[key], self._values[key]))
+        intervals.sort(key=lambda interval: interval[0])
+
+        self._starts[key] = array('q', (interval[0] for interval in intervals))
+        self._ends[key] = array('q', (interval[1] for interval in intervals))
+        self._values[key] = [interval[2] for interval in intervals]
+        self._max_length[key] = max(interval[1] - interval[0] for interval in intervals)
+
+    def overlaps(self, key, start, end):
+        ''' Get the values of the intervals that overlap start and end (inclusive), ordered by interval start.
+        @type  key: string
+        @param key: key the intervals are grouped by eg: ('38', '1')
+        @type  start: integer
+        @param start: query start
+        @type  end: integer
+        @param end: query end
+        '''
+        if key in self._pending:
+            self._build(key)
+        if key not in self._starts:
+            return []
+
+        start = int(start)
+        end = int(end)
+        starts = self._starts[key]
+        ends = self._ends[key]
+        values = self._values[key]
+
+        # intervals starting after the query end cannot overlap, nor can those starting before
+        # (query start - longest interval)
+        hi = bisect_right(starts, end)
+        lo = bisect_right(starts, start - self._max_length[key] - 1)
+        return [values[i] for i in range(lo, hi) if ends[i] >= start]
@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import sqlite3
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class LDCache():
+    ''' Persistent on-disk (SQLite) cache of the markers in LD with a marker, keyed by dataset, build, marker,
+    dprime and rsq. The cache is cleared when the reference panel version it was built with changes.
+    '''
+
+    # one connection per process, sqlite connections can not be shared with forked build workers
+    caches = {}
+
+    def __init__(self, path, panel_version, build='GRCh38'):
+        '''
+        @type  path: string
+        @param path: path of the SQLite database file
+        @type  panel_version: string
+        @param panel_version: version of the LD reference panel, the cache is cleared when it changes
+        @type  build: string
+        @keyword build: genome build of the LD results
+        '''
+        self.path = path
+        self.panel_version = str(panel_version)
+        self.build = build
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS ld_cache (dataset TEXT, build TEXT, marker TEXT, '
+                          'dprime REAL, rsq REAL, ld TEXT, PRIMARY KEY (dataset, build, marker, dprime, rsq))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache_info (name TEXT PRIMARY KEY, value TEXT)')
+        self.conn.commit()
+        self.check_panel_version()
+
+    @classmethod
+    def get_cache(cls):
+        ''' Get the LD cache for this process configured from the LD_CACHE setting (PATH, PANEL_VERSION and
+        BUILD) or None if LD_CACHE is not set. '''
+        ld_cache = getattr(settings, 'LD_CACHE', None)
+        if ld_cache is None:
+            return None
+
+        pid = os.getpid()
+        if pid not in cls.caches:
+            cls.caches[pid] = LDCache(ld_cache.get('PATH'), ld_cache.get('PANEL_VERSION'),
+                                      build=ld_cache.get('BUILD', 'GRCh38'))
+        return cls.caches[pid]
+
+    def check_panel_version(self):
+        ''' Clear the cache if it was built with a different reference panel version. '''
+        row = self.conn.execute("SELECT value FROM cache_info WHERE name = 'panel_version'").fetchone()
+        if row is not None and row[0] == self.panel_version:
+            return
+
+        if row is not None:
+            logger.warning('LD reference panel changed from ' + row[0] + ' to ' + self.panel_version +
+                           ', clearing the LD cache ' + self.path)
+        self.conn.execute('DELETE FROM ld_cache')
+        self.conn.execute("INSERT OR REPLACE INTO cache_info (name, value) VALUES ('panel_version', ?)",
+                          (self.panel_version,))
+        self.conn.commit()
+
+    def get(self, dataset, marker, dprime, rsq):
+        ''' Get the list of markers in LD with marker or None if it is not in the cache. '''
+        row = self.conn.execute('SELECT ld FROM ld_cache WHERE dataset = ? AND build = ? AND marker = ? AND '
+                                'dprime = ? AND rsq = ?', (dataset, self.build, marker, dprime, rsq)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, dataset, marker, dprime, rsq, marker_list):
+        ''' Store the list of markers in LD with marker. '''
+        self.put_many(dataset, dprime, rsq, {marker: marker_list})
+
+    def put_many(self, dataset, dprime, rsq, marker_lists):
+        ''' Store the lists of markers in LD for a dict of marker => list of markers in LD. '''
+        rows = [(dataset, self.build, marker, dprime, rsq, json.dumps(marker_list))
+                for marker, marker_list in marker_lists.items()]
+        self.conn.executemany('INSERT OR REPLACE INTO ld_cache (dataset, build, marker, dprime, rsq, ld) '
+                              'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.conn.commit()
+
+    def clear(self):
+        ''' Remove all the cached LD results. '''
+        self.conn.execute('DELETE FROM ld_cache')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
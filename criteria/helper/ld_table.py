@@ -0,0 +1,179 @@
+import logging
+import mmap
+import os
+import struct
+from array import array
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class LDTable():
+    ''' Precomputed pairwise LD for one chromosome in a memory-mapped binary file, queried in-process as an
+    alternative to ld_run on an Rserve server. The file is only read through the memory map so the build workers
+    share the same page-cached copy.
+
+    File layout (native byte order):
+      header           magic, number of markers, number of pairs, size of the names block
+      name_offsets     uint64[n_markers + 1], offsets of the marker names in the names block
+      pair_offsets     uint64[n_markers + 1], first pair of each marker, pairs of marker i are
+                       pair_offsets[i] to pair_offsets[i + 1]
+      partners         uint32[n_pairs], marker number of the marker in LD
+      rsquared         float32[n_pairs]
+      dprime           float32[n_pairs]
+      names            marker names, sorted, so a marker number is its position in the sorted names
+
+    Pairs are stored in both directions and, for each marker, in decreasing order of rsquared.
+    '''
+
+    MAGIC = b'LDTABLE1'
+    HEADER = struct.Struct('=8sIIQQ')
+
+    # one set of open tables per process
+    tables = {}
+
+    def __init__(self, path):
+        '''
+        @type  path: string
+        @param path: path of the table file for a chromosome
+        '''
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.n_markers, _reserved, n_pairs, names_size) = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC:
+            self.mm.close()
+            raise ValueError(path + ' is not an LD table file')
+
+        buf = memoryview(self.mm)
+        pos = self.HEADER.size
+        (self.name_offsets, pos) = self._view(buf, pos, 'Q', self.n_markers + 1)
+        (self.pair_offsets, pos) = self._view(buf, pos, 'Q', self.n_markers + 1)
+        (self.partners, pos) = self._view(buf, pos, 'I', n_pairs)
+        (self.rsquared, pos) = self._view(buf, pos, 'f', n_pairs)
+        (self.dprime, pos) = self._view(buf, pos, 'f', n_pairs)
+        self.names_start = pos
+
+    @classmethod
+    def _view(cls, buf, pos, typecode, length):
+        end = pos + array(typecode).itemsize * length
+        return (buf[pos:end].cast(typecode), end)
+
+    @classmethod
+    def is_enabled(cls):
+        ''' True if the LD_TABLE setting is set, in which case LD is read from the tables rather than Rserve. '''
+        return getattr(settings, 'LD_TABLE', None) is not None
+
+    @classmethod
+    def get_table_path(cls, dataset, seqid):
+        ''' Get the path of the table for a dataset and chromosome, PATH/dataset/chr<seqid>.ld '''
+        return os.path.join(getattr(settings, 'LD_TABLE').get('PATH'), dataset, 'chr' + str(seqid) + '.ld')
+
+    @classmethod
+    def get_table(cls, dataset, seqid):
+        ''' Get the open table for a dataset and chromosome or None if there is no table file for it. '''
+        key = (os.getpid(), dataset, str(seqid))
+        if key not in cls.tables:
+            path = cls.get_table_path(dataset, seqid)
+            if os.path.exists(path):
+                cls.tables[key] = LDTable(path)
+            else:
+                logger.warning('No LD table ' + path)
+                cls.tables[key] = None
+        return cls.tables[key]
+
+    @classmethod
+    def ld_run(cls, dataset, seqid, marker, dprime=0, rsq=0.8):
+        ''' Get the markers in LD with a marker, with the same output as ld_run in R. '''
+        table = cls.get_table(dataset, seqid)
+        if table is None:
+            return {'error': 'No LD table for ' + dataset + ' chromosome ' + str(seqid)}
+        return table.ld(marker, dprime=dprime, rsq=rsq)
+
+    def get_marker_number(self, marker):
+        ''' Binary search of the sorted marker names, returns the marker number or None if it is not found. '''
+        name = marker.encode('utf-8')
+        (lo, hi) = (0, self.n_markers)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_marker_name(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_markers and self.get_marker_name(lo) == name:
+            return lo
+        return None
+
+    def get_marker_name(self, number):
+        return self.mm[self.names_start + self.name_offsets[number]:self.names_start + self.name_offsets[number + 1]]
+
+    def ld(self, marker, dprime=0, rsq=0.8):
+        ''' Get the markers in LD with a marker with rsquared and dprime of at least rsq and dprime.
+        @type  marker: string
+        @param marker: marker id eg: rs2476601
+        @type  dprime: float
+        @keyword dprime: minimum dprime
+        @type  rsq: float
+        @keyword rsq: minimum rsquared
+        '''
+        number = self.get_marker_number(marker)
+        if number is None:
+            return {'error': 'Marker ' + marker + ' not found in ' + self.path}
+
+        marker_list = []
+        for i in range(self.pair_offsets[number], self.pair_offsets[number + 1]):
+            rsquared = self.rsquared[i]
+            # pairs are in decreasing order of rsquared
+            if rsquared < rsq:
+                break
+            if self.dprime[i] < dprime:
+                continue
+            marker_list.append({'marker2': self.get_marker_name(self.partners[i]).decode('utf-8'),
+                                'rsquared': round(rsquared, 4), 'dprime': round(self.dprime[i], 4)})
+        return {'ld': marker_list}
+
+    def close(self):
+        for view in (self.name_offsets, self.pair_offsets, self.partners, self.rsquared, self.dprime):
+            view.release()
+        self.mm.close()
+
+    @classmethod
+    def write(cls, path, pairs):
+        ''' Write a table file from the pairwise LD of one chromosome.
+        @type  path: string
+        @param path: path of the table file
+        @param pairs: iterable of (marker1, marker2, rsquared, dprime), each pair only needs to be given once
+        '''
+        marker_pairs = {}
+        for (marker1, marker2, rsquared, dprime) in pairs:
+            marker_pairs.setdefault(marker1, []).append((marker2, float(rsquared), float(dprime)))
+            marker_pairs.setdefault(marker2, []).append((marker1, float(rsquared), float(dprime)))
+
+        names = sorted(marker_pairs.keys(), key=lambda marker: marker.encode('utf-8'))
+        marker_numbers = {marker: number for number, marker in enumerate(names)}
+
+        name_offsets = array('Q', [0])
+        pair_offsets = array('Q', [0])
+        partners = array('I')
+        rsquared = array('f')
+        dprime = array('f')
+        encoded_names = []
+        for marker in names:
+            encoded_names.append(marker.encode('utf-8'))
+            name_offsets.append(name_offsets[-1] + len(encoded_names[-1]))
+            for (marker2, pair_rsq, pair_dprime) in sorted(marker_pairs[marker], key=lambda pair: -pair[1]):
+                partners.append(marker_numbers[marker2])
+                rsquared.append(pair_rsq)
+                dprime.append(pair_dprime)
+            pair_offsets.append(len(partners))
+
+        names_block = b''.join(encoded_names)
+        with open(path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(names), 0, len(partners), len(names_block)))
+            for values in (name_offsets, pair_offsets, partners, rsquared, dprime):
+                values.tofile(f)
+            f.write(names_block)
+        return len(names)
@@ -2,11 +2,10 @@ import logging
 from builtins import classmethod
 from region import utils
 from elastic.result import Document
-from criteria.helper.criteria import Criteria
-from django.conf import settings
-import pyRserve
-from elastic.query import BoolQuery, Query
-from elastic.search import ElasticQuery, Search
+from criteria.helper.criteria import Criteria, criteria_fields
+from criteria.helper.ld_cache import LDCache
+from criteria.helper.ld_table import LDTable
+from criteria.helper.rserve_pool import RservePool
 from elastic.elastic_settings import ElasticSettings
 import json
 from criteria.helper.criteria_manager import CriteriaManager
@@ -90,6 +89,7 @@ class MarkerCriteria(Criteria):
         return result_container_
 
     @classmethod
+    @criteria_fields('marker', 'disease', 'status', 'disease_locus', 'dil_study_id')
     def rsq_with_index_snp(cls, hit, section=None, config=None, result_container={}):
         feature_doc = hit['_source']
         feature_doc['_id'] = hit['_id']
@@ -125,30 +125,14 @@ class MarkerCriteria(Criteria):
         # for the marker2 that is in ld with marker1, tag it with the right disease and studyid
         # query study index with the above dil_study_id to get the author name
 
-        query = ElasticQuery(BoolQuery(must_arr=[Query.term("id", marker1)]), sources=['seqid', 'start'])
-        elastic = Search(search_query=query, idx=ElasticSettings.idx('MARKER', 'MARKER'), size=1)
-        docs = elastic.search().docs
-        marker_doc = None
-
-        if docs is not None and len(docs) > 0:
-            marker_doc = elastic.search().docs[0]
-
-        if marker_doc is None:
+        seqid = cls.get_marker_seqid(marker1)
+        if seqid is None:
             return result_container
 
-        seqid = getattr(marker_doc, 'seqid')
-
-        rserve = getattr(settings, 'RSERVE')
-
-        conn = pyRserve.connect(host=rserve.get('HOST'), port=rserve.get('PORT'))
         dataset = 'EUR'
         rsq = 0.8
 
-        ld_str = conn.r.ld_run(dataset, seqid, marker1,
-                               dprime=0, rsq=rsq)
-        ld_str = ld_str.replace('D.prime', 'dprime').replace('R.squared', 'rsquared')
-        conn.close()
-        ld = json.loads(str(ld_str))
+        ld = cls.get_ld(dataset, seqid, marker1, dprime=0, rsq=rsq)
 
         if 'error' in ld:
             global error_counter
@@ -166,11 +150,7 @@ class MarkerCriteria(Criteria):
         global all_counter
         all_counter = all_counter + len(marker_list)
 
-        query = ElasticQuery(Query.ids([dil_study_id]))
-        elastic = Search(search_query=query, idx=ElasticSettings.idx('STUDY', 'STUDY'), size=1)
-        study_doc = elastic.search().docs[0]
-        author = getattr(study_doc, 'authors')[0]
-        first_author = author['name'] + ' ' + author['initials']
+        first_author = cls.get_first_author(dil_study_id)
 
         for marker_dict in marker_list:
 
@@ -192,6 +172,130 @@ class MarkerCriteria(Criteria):
         return result_container
 
     @classmethod
+    def rsq_with_index_snp_prefetch(cls, hits, section=None, config=None):
+        '''function to fetch the seqids and the LD of all the index markers of a scroll page in batches, one
+        marker query for the page and one R call per chromosome, used by rsq_with_index_snp when ld_batch is set
+        in the section config
+        '''
+        if section is None or config is None or not config[section].getboolean('ld_batch', False):
+            return
+
+        markers = set()
+        for hit in hits:
+            feature_doc = hit['_source']
+            if feature_doc.get('marker') is None or feature_doc.get('disease') is None:
+                continue
+            if feature_doc.get('status') != 'N' or feature_doc.get('disease_locus', '').lower() == 'tbc':
+                continue
+            markers.add(feature_doc['marker'])
+
+        marker_seqids = cls.get_marker_seqids(markers)
+
+        markers_by_seqid = {}
+        for marker, seqid in marker_seqids.items():
+            markers_by_seqid.setdefault(seqid, []).append(marker)
+
+        for seqid, seqid_markers in markers_by_seqid.items():
+            cls.get_ld_batch('EUR', seqid, seqid_markers, dprime=0, rsq=0.8)
+
+    @classmethod
+    def get_marker_seqid(cls, marker):
+        '''function to get the seqid of a marker, from the markers already fetched in this build if possible
+        '''
+        return cls.get_marker_seqids([marker]).get(marker)
+
+    @classmethod
+    def get_marker_seqids(cls, markers, batch_size=1000):
+        '''function to get the seqids for a list of markers with terms queries of up to batch_size markers
+        (see Criteria.get_docs_by_ids), returns a dict of marker => seqid for the markers that are found.
+        '''
+        marker_docs = cls.get_docs_by_ids(ElasticSettings.idx('MARKER', 'MARKER'), list(markers),
+                                          sources=Criteria.MARKER_SOURCES, batch_size=batch_size, field='id')
+        return {marker: getattr(doc, 'seqid') for marker, doc in marker_docs.items()}
+
+    @classmethod
+    def get_ld(cls, dataset, seqid, marker, dprime=0, rsq=0.8):
+        '''function to get the markers in LD with a marker (from R ld_run), using the results already fetched
+        in a batch if there are any. If LD_TABLE is set the local LD tables are used instead of Rserve.
+        '''
+        if LDTable.is_enabled():
+            return LDTable.ld_run(dataset, seqid, marker, dprime=dprime, rsq=rsq)
+
+        ld_results = Criteria.build_caches.setdefault('ld_results', {})
+        ld_key = (dataset, str(seqid), marker, dprime, rsq)
+        if ld_key in ld_results:
+            return ld_results[ld_key]
+
+        ld_cache = LDCache.get_cache()
+        if ld_cache is not None:
+            marker_list = ld_cache.get(dataset, marker, dprime, rsq)
+            Criteria.count_lookup('ld_cache', hit=marker_list is not None)
+            if marker_list is not None:
+                return {'ld': marker_list}
+
+        with RservePool.get_pool().connection() as conn:
+            ld_str = conn.r.ld_run(dataset, seqid, marker, dprime=dprime, rsq=rsq)
+        ld = cls.parse_ld(ld_str)
+
+        if ld_cache is not None and 'error' not in ld:
+            ld_cache.put(dataset, marker, dprime, rsq, ld.get('ld') or [])
+        return ld
+
+    @classmethod
+    def get_ld_batch(cls, dataset, seqid, markers, dprime=0, rsq=0.8):
+        '''function to run ld_run for many markers on the same chromosome in a single R call. The results are
+        kept for get_ld and also returned as a dict of marker => ld. Markers found in the LD cache are not sent
+        to R. If LD_TABLE is set the local LD tables are used instead of Rserve.
+        '''
+        if LDTable.is_enabled():
+            return {marker: LDTable.ld_run(dataset, seqid, marker, dprime=dprime, rsq=rsq) for marker in markers}
+
+        ld_results = Criteria.build_caches.setdefault('ld_results', {})
+        ld_batch = {}
+
+        ld_cache = LDCache.get_cache()
+        if ld_cache is not None:
+            for marker in markers:
+                marker_list = ld_cache.get(dataset, marker, dprime, rsq)
+                Criteria.count_lookup('ld_cache', hit=marker_list is not None)
+                if marker_list is not None:
+                    ld_batch[marker] = {'ld': marker_list}
+                    ld_results[(dataset, str(seqid), marker, dprime, rsq)] = ld_batch[marker]
+
+        markers = [marker for marker in markers if marker not in ld_batch]
+        if len(markers) == 0:
+            return ld_batch
+
+        r_expr = ("unname(vapply(ld_markers, function(m) tryCatch(ld_run('%s', '%s', m, dprime=%s, rsq=%s), "
+                  "error=function(e) '{\"error\": \"ld_run failed\"}'), character(1)))" %
+                  (dataset, seqid, dprime, rsq))
+
+        with RservePool.get_pool().connection() as conn:
+            conn.r.ld_markers = markers
+            ld_strs = conn.eval(r_expr)
+
+        if isinstance(ld_strs, str):
+            ld_strs = [ld_strs]
+
+        marker_lists = {}
+        for marker, ld_str in zip(markers, ld_strs):
+            ld_batch[marker] = cls.parse_ld(ld_str)
+            ld_results[(dataset, str(seqid), marker, dprime, rsq)] = ld_batch[marker]
+            if 'error' not in ld_batch[marker]:
+                marker_lists[marker] = ld_batch[marker].get('ld') or []
+
+        if ld_cache is not None and len(marker_lists) > 0:
+            ld_cache.put_many(dataset, dprime, rsq, marker_lists)
+        return ld_batch
+
+    @classmethod
+    def parse_ld(cls, ld_str):
+        '''function to parse the json returned by ld_run'''
+        ld_str = str(ld_str).replace('D.prime', 'dprime').replace('R.squared', 'rsquared')
+        return json.loads(ld_str)
+
+    @classmethod
+    @criteria_fields('marker', 'disease', 'status', 'disease_locus', 'dil_study_id', 'p_values')
     def marker_is_gwas_significant_in_study(cls, hit, section=None, config=None, result_container={}):
         gw_sig_p = 0.00000005
         feature_doc = hit['_source']
@@ -244,11 +348,7 @@ class MarkerCriteria(Criteria):
 
         p_val_to_compare = float(p_val_to_compare)
         if p_val_to_compare < gw_sig_p:
-            query = ElasticQuery(Query.ids([dil_study_id]))
-            elastic = Search(search_query=query, idx=ElasticSettings.idx('STUDY', 'STUDY'), size=1)
-            study_doc = elastic.search().docs[0]
-            author = getattr(study_doc, 'authors')[0]
-            first_author = author['name'] + ' ' + author['initials']
+            first_author = cls.get_first_author(dil_study_id)
             fnotes = {'linkdata': 'pval', 'linkvalue': p_val_to_compare,
                       'linkid': dil_study_id, 'linkname': first_author}
             result_container_populated = cls.populate_container(dil_study_id,
@@ -261,6 +361,7 @@ class MarkerCriteria(Criteria):
             return result_container
 
     @classmethod
+    @criteria_fields('marker', 'p_value')
     def marker_is_gwas_significant_in_ic(cls, hit, section=None, config=None, result_container={}):
         '''
         /hg38_gwas_statistics,hg38_ic_statistics/_search?pretty' -d '{"query":{"range":{"p_value":{"lt": 0.00000005}}}}'
@@ -275,13 +376,9 @@ class MarkerCriteria(Criteria):
 
         # get meta data
         # studyid and diseaes
-        elastic_url = ElasticSettings.url()
-        meta_url = idx + '/' + idx_type + '/_mapping'
-        meta_response = Search.elastic_request(elastic_url, meta_url, is_post=False)
+        meta_info = cls.get_index_meta(idx, idx_type)
 
         try:
-            elastic_meta = json.loads(meta_response.content.decode("utf-8"))
-            meta_info = elastic_meta[idx]['mappings'][idx_type]['_meta']
             disease = meta_info['disease']
             dil_study_id = meta_info['study']
         except:
@@ -307,11 +404,7 @@ class MarkerCriteria(Criteria):
                 first_author = 'NA'
                 dil_study_id = 'NA'
             else:
-                query = ElasticQuery(Query.ids([dil_study_id]))
-                elastic = Search(search_query=query, idx=ElasticSettings.idx('STUDY', 'STUDY'), size=1)
-                study_doc = elastic.search().docs[0]
-                author = getattr(study_doc, 'authors')[0]
-                first_author = author['name'] + ' ' + author['initials']
+                first_author = cls.get_first_author(dil_study_id)
 
             fnotes = {'linkdata': 'pval', 'linkvalue': p_val_to_compare,
                       'linkid': dil_study_id, 'linkname': first_author}
@@ -1,9 +1,7 @@
 import logging
 from builtins import classmethod
-from criteria.helper.criteria import Criteria
-from elastic.search import ElasticQuery, Search
+from criteria.helper.criteria import Criteria, criteria_fields
 from elastic.elastic_settings import ElasticSettings
-from elastic.query import Query
 from criteria.helper.criteria_manager import CriteriaManager
 
 
@@ -37,6 +35,7 @@ class RegionCriteria(Criteria):
         return result_container_
 
     @classmethod
+    @criteria_fields('disease_loci', 'region_id')
     def is_region_for_disease(cls, hit, section=None, config=None, result_container={}):
 
         result_container_populated = result_container
@@ -45,32 +44,33 @@ class RegionCriteria(Criteria):
         disease_loci = feature_doc['disease_loci']
         region_id = feature_doc['region_id']
 
+        disease_locus_docs = cls.get_disease_locus_docs(disease_loci)
+
         diseases = set()
         for disease_locus_id in disease_loci:
+            if disease_locus_id not in disease_locus_docs:
+                continue
 
-            query = ElasticQuery(Query.ids([disease_locus_id]), sources=['hits'])
-            elastic = Search(query, idx=ElasticSettings.idx('REGION', idx_type='DISEASE_LOCUS'))
-            disease_locus_hits = elastic.search().docs
-
-            for disease_locus_hit in disease_locus_hits:
-                hits = getattr(disease_locus_hit, 'hits')
-                for hit in hits:
-                    query = ElasticQuery(Query.ids([hit]))
-                    elastic = Search(query, idx=ElasticSettings.idx('REGION', idx_type='STUDY_HITS'))
-                    hit_doc = elastic.search().docs[0]
+            hits = getattr(disease_locus_docs[disease_locus_id], 'hits')
+            study_hit_docs = cls.get_study_hit_docs(hits)
+            for hit in hits:
+                hit_doc = study_hit_docs.get(hit)
+                if hit_doc is None:
+                    logger.debug('Study hit ' + hit + ' of ' + disease_locus_id + ' not found')
+                    continue
 
-                    disease = getattr(hit_doc, "disease")
-                    status = getattr(hit_doc, "status")
+                disease = getattr(hit_doc, "disease")
+                status = getattr(hit_doc, "status")
 
-                    if status != 'N':
-                        return result_container
+                if status != 'N':
+                    return result_container
 
-                    disease_loci = getattr(hit_doc, "disease_locus").lower()
+                disease_loci = getattr(hit_doc, "disease_locus").lower()
 
-                    if disease_loci == 'tbc':
-                        return result_container
+                if disease_loci == 'tbc':
+                    return result_container
 
-                    diseases.add(disease)
+                diseases.add(disease)
 
         for disease in diseases:
 
@@ -81,6 +81,33 @@ class RegionCriteria(Criteria):
                                                                 result_container=result_container_populated)
         return result_container_populated
 
+    @classmethod
+    def is_region_for_disease_prefetch(cls, hits, section=None, config=None):
+        '''function to fetch the disease loci of all the regions of a scroll page, and then all their study hits,
+        in batches rather than one query per disease locus and per study hit
+        '''
+        disease_loci = []
+        for hit in hits:
+            disease_loci.extend(hit['_source'].get('disease_loci', []))
+
+        study_hits = []
+        for disease_locus_doc in cls.get_disease_locus_docs(disease_loci).values():
+            study_hits.extend(getattr(disease_locus_doc, 'hits'))
+        cls.get_study_hit_docs(study_hits)
+
+    @classmethod
+    def get_disease_locus_docs(cls, disease_locus_ids):
+        '''function to get the disease locus docs (with their study hits) as a dict of id => doc'''
+        return cls.get_docs_by_ids(ElasticSettings.idx('REGION', idx_type='DISEASE_LOCUS'), disease_locus_ids,
+                                   sources=['hits'])
+
+    @classmethod
+    def get_study_hit_docs(cls, hit_ids):
+        '''function to get the study hit docs as a dict of id => doc, study hits are shared between regions so
+        they are kept for the rest of the build'''
+        return cls.get_docs_by_ids(ElasticSettings.idx('REGION', idx_type='STUDY_HITS'), hit_ids,
+                                   sources=['disease', 'status', 'disease_locus'])
+
     @classmethod
     def get_disease_tags(cls, feature_id, idx_type=None):
         'Function to get disease tags for a given feature_id...delegated to parent class Criteria. Returns disease docs'
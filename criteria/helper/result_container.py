@@ -0,0 +1,289 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+class CriteriaList(list):
+    ''' List of the criteria dicts ({'fid': ..., 'fname': ..., 'fnotes': ...}) of a feature and disease in a result
+    container. A set of hashable keys of the dicts is kept alongside the list so that duplicates are found in O(1)
+    rather than by comparing with every dict in the list. It is still a list of dicts when loaded or compared.
+    '''
+
+    def __init__(self, criteria_dicts=()):
+        super().__init__()
+        self.keys = set()
+        for criteria_dict in criteria_dicts:
+            self.append(criteria_dict)
+
+    @classmethod
+    def get_key(cls, value):
+        ''' Get a hashable key for a criteria dict (or any of its values). '''
+        if isinstance(value, dict):
+            return tuple(sorted((key, cls.get_key(item)) for key, item in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(cls.get_key(item) for item in value)
+        try:
+            hash(value)
+            return value
+        except TypeError:
+            return repr(value)
+
+    def append(self, criteria_dict):
+        ''' Add a criteria dict unless an equal one is already in the list, returns True if it was added. '''
+        key = self.get_key(criteria_dict)
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        super().append(criteria_dict)
+        return True
+
+    def __contains__(self, criteria_dict):
+        return self.get_key(criteria_dict) in self.keys
+
+
+class CompactResultContainer():
+    ''' Result container for very large builds, with the same interface as the dict result container
+    (feature_id => {disease: [criteria dicts]}) for populate_container and load_result_container.
+
+    Feature ids, disease codes and the fid and fname of the criteria are interned, and each criteria is kept as a
+    (fid, fname, fnotes) tuple shared by every feature and disease it is tagged to. Equal fnotes dicts are stored
+    once. The criteria dicts of a feature are only built when the feature is read (eg: when it is loaded).
+    '''
+
+    # lists longer than this also get a set of their records for the duplicate check
+    SET_THRESHOLD = 32
+
+    def __init__(self):
+        self.features = {}
+        self.records = {}
+        self.fnotes = {}
+        self.record_sets = {}
+
+    @classmethod
+    def intern(cls, value):
+        return sys.intern(value) if isinstance(value, str) else value
+
+    def get_record(self, fid, fname, fnotes=None):
+        ''' Get the shared (fid, fname, fnotes) record for a criteria. '''
+        if fnotes is not None and len(fnotes) > 0:
+            fnotes_key = CriteriaList.get_key(fnotes)
+            fnotes = self.fnotes.setdefault(fnotes_key, fnotes)
+        else:
+            fnotes = None
+        record = (self.intern(fid), self.intern(fname), fnotes)
+        return self.records.setdefault((record[0], record[1], None if fnotes is None else fnotes_key), record)
+
+    def add(self, fid, fname, fnotes=None, features=None, diseases=None):
+        ''' Tag the features to the diseases with a criteria (see L{Criteria.populate_container}). '''
+        record = self.get_record(fid, fname, fnotes)
+        diseases = [self.intern(disease) for disease in diseases]
+        for feature in features:
+            if feature is None:
+                continue
+            disease_records = self.features.setdefault(self.intern(feature), {})
+            for disease in diseases:
+                self.add_record(feature, disease_records.setdefault(disease, []), disease, record)
+
+    def add_record(self, feature, records, disease, record):
+        # records are shared (see get_record) and fnotes dicts are not hashable, so the sets hold the record ids
+        set_key = (feature, disease)
+        if set_key in self.record_sets:
+            record_set = self.record_sets[set_key]
+            if id(record) in record_set:
+                return
+            record_set.add(id(record))
+        elif record in records:
+            return
+        elif len(records) >= self.SET_THRESHOLD:
+            self.record_sets[set_key] = set(id(existing) for existing in records)
+            self.record_sets[set_key].add(id(record))
+        records.append(record)
+
+    @classmethod
+    def record_to_dict(cls, record):
+        if record[2] is None:
+            return {'fid': record[0], 'fname': record[1]}
+        return {'fid': record[0], 'fname': record[1], 'fnotes': record[2]}
+
+    def __getitem__(self, feature_id):
+        return {disease: CriteriaList(self.record_to_dict(record) for record in records)
+                for disease, records in self.features[feature_id].items()}
+
+    def get(self, feature_id, default=None):
+        if feature_id not in self.features:
+            return default
+        return self[feature_id]
+
+    def __contains__(self, feature_id):
+        return feature_id in self.features
+
+    def __iter__(self):
+        return iter(self.features)
+
+    def __len__(self):
+        return len(self.features)
+
+    def keys(self):
+        return self.features.keys()
+
+    def items(self):
+        for feature_id in self.features:
+            yield (feature_id, self[feature_id])
+
+
+class DiskResultContainer():
+    ''' Result container that keeps a bounded working set of features in memory (a L{CompactResultContainer}) and
+    spills it to a local SQLite file when it reaches max_features, merging the criteria of features that were
+    already spilled. Reading the container (eg: load_result_container) streams the features from the file, merged
+    with the working set, without spilling. It has the same interface as the dict result container for
+    populate_container and load_result_container. The file is only created on the first spill and is removed by
+    close().
+    '''
+
+    def __init__(self, max_features=100000, spill_dir=None):
+        '''
+        @type  max_features: integer
+        @keyword max_features: maximum number of features in the in-memory working set
+        @type  spill_dir: string
+        @keyword spill_dir: directory for the spill file [default: the system temporary directory]
+        '''
+        self.max_features = max_features
+        self.spill_dir = spill_dir
+        self.path = None
+        self.conn = None
+        self.working_set = CompactResultContainer()
+        # number of features in the spill file and of features in the working set that are not in the file
+        self.spilled_count = 0
+        self.new_count = 0
+
+    def add(self, fid, fname, fnotes=None, features=None, diseases=None):
+        ''' Tag the features to the diseases with a criteria (see L{Criteria.populate_container}). '''
+        for feature in set(features):
+            if feature is not None and feature not in self.working_set and not self.is_spilled(feature):
+                self.new_count += 1
+        self.working_set.add(fid, fname, fnotes=fnotes, features=features, diseases=diseases)
+        if len(self.working_set) >= self.max_features:
+            self.spill()
+
+    def get_conn(self):
+        if self.conn is None:
+            if self.path is None:
+                (fd, self.path) = tempfile.mkstemp(prefix='criteria_', suffix='.sqlite', dir=self.spill_dir)
+                os.close(fd)
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS features (feature_id TEXT PRIMARY KEY, doc TEXT)')
+        return self.conn
+
+    def is_spilled(self, feature_id):
+        if self.path is None:
+            return False
+        row = self.get_conn().execute('SELECT 1 FROM features WHERE feature_id = ?', (feature_id,)).fetchone()
+        return row is not None
+
+    def get_spilled(self, feature_id):
+        ''' Get the criteria of a feature in the spill file, or None if it is not in the file. '''
+        if self.path is None:
+            return None
+        row = self.get_conn().execute('SELECT doc FROM features WHERE feature_id = ?', (feature_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def merge_working_set(self, feature_id, row):
+        ''' Merge the criteria of a feature in the working set in to row (its criteria in the spill file). '''
+        for disease, criteria_dicts in self.working_set[feature_id].items():
+            criteria_list = CriteriaList(row.get(disease, []))
+            for criteria_dict in criteria_dicts:
+                criteria_list.append(criteria_dict)
+            row[disease] = criteria_list
+        return row
+
+    def spill(self, batch_size=500):
+        ''' Merge the working set in to the spill file and empty the working set. '''
+        if len(self.working_set) == 0:
+            return
+
+        conn = self.get_conn()
+        feature_ids = list(self.working_set.keys())
+        for i in range(0, len(feature_ids), batch_size):
+            batch_ids = feature_ids[i:i + batch_size]
+            spilled = dict(conn.execute('SELECT feature_id, doc FROM features WHERE feature_id IN (' +
+                                        ','.join('?' * len(batch_ids)) + ')', batch_ids))
+            rows = []
+            for feature_id in batch_ids:
+                row = json.loads(spilled[feature_id]) if feature_id in spilled else {}
+                rows.append((feature_id, json.dumps(self.merge_working_set(feature_id, row))))
+            conn.executemany('INSERT OR REPLACE INTO features (feature_id, doc) VALUES (?, ?)', rows)
+        conn.commit()
+
+        logger.warning('Spilled ' + str(len(feature_ids)) + ' features to ' + self.path)
+        self.working_set = CompactResultContainer()
+        self.spilled_count += self.new_count
+        self.new_count = 0
+
+    def items(self):
+        if self.path is None:
+            for item in self.working_set.items():
+                yield item
+        else:
+            merged = set()
+            for (feature_id, doc) in self.get_conn().execute('SELECT feature_id, doc FROM features'):
+                row = json.loads(doc)
+                if feature_id in self.working_set:
+                    merged.add(feature_id)
+                    row = self.merge_working_set(feature_id, row)
+                yield (feature_id, row)
+            for feature_id in list(self.working_set.keys()):
+                if feature_id not in merged:
+                    yield (feature_id, self.working_set[feature_id])
+
+    def keys(self):
+        for (feature_id, _row) in self.items():
+            yield feature_id
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, feature_id):
+        row = self.get_spilled(feature_id)
+        if feature_id in self.working_set:
+            return self.merge_working_set(feature_id, {} if row is None else row)
+        if row is None:
+            raise KeyError(feature_id)
+        return row
+
+    def get(self, feature_id, default=None):
+        try:
+            return self[feature_id]
+        except KeyError:
+            return default
+
+    def __contains__(self, feature_id):
+        return feature_id in self.working_set or self.is_spilled(feature_id)
+
+    def __len__(self):
+        return self.spilled_count + self.new_count
+
+    def close(self):
+        ''' Close and remove the spill file. '''
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+        self.working_set = CompactResultContainer()
+        self.spilled_count = 0
+        self.new_count = 0
+
+    def __getstate__(self):
+        # sent back from a scan slice worker: spill everything and pass the spill file rather than the connection
+        if self.path is not None:
+            self.spill()
+            self.conn.close()
+            self.conn = None
+        return dict(self.__dict__)
@@ -0,0 +1,98 @@
+import logging
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+import pyRserve
+
+
+logger = logging.getLogger(__name__)
+
+
+class RservePool():
+    ''' Pool of warm Rserve connections. Connections are opened as they are needed, up to size, and returned to
+    the pool after use so that each R call does not pay for the connection setup. A connection that raises an
+    error is closed rather than returned to the pool.
+    '''
+
+    # one pool per process, connections can not be shared with forked build workers
+    pools = {}
+
+    def __init__(self, host, port, size=4, connect=pyRserve.connect):
+        '''
+        @type  host: string
+        @param host: Rserve host
+        @type  port: integer
+        @param port: Rserve port
+        @type  size: integer
+        @keyword size: maximum number of open connections
+        @keyword connect: function to open a connection, called with host and port
+        '''
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connect = connect
+        self.idle = queue.LifoQueue()
+        self.open_count = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls):
+        ''' Get the pool for this process, configured from the RSERVE setting (HOST, PORT and POOL_SIZE). '''
+        pid = os.getpid()
+        if pid not in cls.pools:
+            rserve = getattr(settings, 'RSERVE')
+            cls.pools[pid] = RservePool(rserve.get('HOST'), rserve.get('PORT'), size=rserve.get('POOL_SIZE', 4))
+        return cls.pools[pid]
+
+    @contextmanager
+    def connection(self):
+        ''' Context manager to borrow a connection from the pool. '''
+        conn = self._get()
+        try:
+            yield conn
+        except:
+            self._discard(conn)
+            raise
+        else:
+            self.idle.put(conn)
+
+    def close(self):
+        ''' Close the idle connections. '''
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def _get(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            can_open = self.open_count < self.size
+            if can_open:
+                self.open_count += 1
+
+        if not can_open:
+            return self.idle.get()
+
+        try:
+            return self.connect(host=self.host, port=self.port)
+        except:
+            with self.lock:
+                self.open_count -= 1
+            raise
+
+    def _discard(self, conn):
+        with self.lock:
+            self.open_count -= 1
+        try:
+            conn.close()
+        except Exception as e:
+            logger.warning('Error closing Rserve connection: ' + str(e))
@@ -1,6 +1,6 @@
 import logging
 from builtins import classmethod
-from criteria.helper.criteria import Criteria
+from criteria.helper.criteria import Criteria, criteria_fields
 from elastic.elastic_settings import ElasticSettings
 from criteria.helper.criteria_manager import CriteriaManager
 
@@ -19,6 +19,7 @@ class StudyCriteria(Criteria):
     FEATURE_TYPE = 'study'
 
     @classmethod
+    @criteria_fields('diseases', 'study_id')
     def study_for_disease(cls, hit, section=None, config=None, result_container={}):
 
         result_container_populated = result_container
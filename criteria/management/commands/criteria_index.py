@@ -10,6 +10,9 @@ class Command(BaseCommand):
     ./manage.py criteria_index --feature gene --criteria cand_gene_in_study
     ./manage.py criteria_index --feature gene --test
     ./manage.py criteria_index --feature marker --criteria is_in_mhc
+    ./manage.py criteria_index --feature marker --workers 4
+    ./manage.py criteria_index --feature marker --criteria is_marker_in_mhc --slices 8
+    ./manage.py criteria_index --feature gene,marker --shared-scan
     '''
     help = "Create criteria indexes(s)."
 
@@ -28,6 +31,20 @@ class Command(BaseCommand):
                             dest='test',
                             action='store_true',
                             help='Run in test mode')
+        parser.add_argument('--workers',
+                            dest='workers',
+                            type=int,
+                            default=1,
+                            help='Number of criteria sections to build at the same time [default: 1].')
+        parser.add_argument('--slices',
+                            dest='slices',
+                            type=int,
+                            help='Number of slices to split the scan of a source index into [default: scan_slices '
+                                 'in criteria.ini or 1].')
+        parser.add_argument('--shared-scan',
+                            dest='shared_scan',
+                            action='store_true',
+                            help='Build the criterias with the same source index and type from one scan.')
 
     def handle(self, *args, **options):
         criteria_manager = CriteriaManager()
@@ -41,10 +58,15 @@ class Command(BaseCommand):
             show_ = options['show']
         if 'test' in options:
             test_ = options['test']
+        workers_ = options.get('workers') or 1
+        slices_ = options.get('slices')
+        shared_scan_ = options.get('shared_scan', False)
 
         if test_:
             config_ = criteria_manager.get_criteria_config(ini_file='test_criteria.ini')
         else:
             config_ = criteria_manager.get_criteria_config(ini_file='criteria.ini')
 
-        criteria_manager.process_criterias(feature=feature_, criteria=criteria_, config=config_, show=show_, test=test_)
+        criteria_manager.process_criterias(feature=feature_, criteria=criteria_, config=config_, show=show_,
+                                           test=test_, workers=workers_, slices=slices_,
+                                           shared_scan=shared_scan_)
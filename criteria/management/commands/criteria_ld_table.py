@@ -0,0 +1,41 @@
+''' Command line tool to build the local LD tables. '''
+import os
+from django.core.management.base import BaseCommand
+from criteria.helper.ld_table import LDTable
+
+
+class Command(BaseCommand):
+    '''
+    Build the memory-mapped LD tables, one per chromosome, from PLINK --r2 dprime output
+    (columns CHR_A BP_A SNP_A CHR_B BP_B SNP_B R2 DP):
+    ./manage.py criteria_ld_table --plink EUR_chr1.ld --dataset EUR --dir /data/ld_table
+    '''
+    help = "Build the LD tables used instead of Rserve for rsq_with_index_snp."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--plink',
+                            dest='plink',
+                            help='PLINK pairwise LD file (--r2 dprime)', required=True)
+        parser.add_argument('--dataset',
+                            dest='dataset',
+                            help='LD dataset (e.g. EUR)', required=True)
+        parser.add_argument('--dir',
+                            dest='dir',
+                            help='LD table directory (PATH in the LD_TABLE setting)', required=True)
+
+    def handle(self, *args, **options):
+        pairs = {}
+        with open(options['plink']) as f:
+            header = f.readline().split()
+            cols = {name: header.index(name) for name in ('CHR_A', 'SNP_A', 'SNP_B', 'R2', 'DP')}
+            for line in f:
+                parts = line.split()
+                pairs.setdefault(parts[cols['CHR_A']], []).append(
+                    (parts[cols['SNP_A']], parts[cols['SNP_B']], parts[cols['R2']], parts[cols['DP']]))
+
+        dataset_dir = os.path.join(options['dir'], options['dataset'])
+        os.makedirs(dataset_dir, exist_ok=True)
+        for seqid, seqid_pairs in pairs.items():
+            path = os.path.join(dataset_dir, 'chr' + seqid + '.ld')
+            n_markers = LDTable.write(path, seqid_pairs)
+            print(path + ': ' + str(n_markers) + ' markers, ' + str(len(seqid_pairs)) + ' pairs')
@@ -116,7 +116,7 @@ class CriteriaFilterBackend(ElasticFilterBackend):
         json_results = s.get_json_response()
         results = []
         for result in json_results['hits']['hits']:
-            new_obj = ElasticObject(initial=result['_source'])
+            new_obj = ElasticObject(initial=Criteria.get_criteria_source(result['_source']))
             new_obj.uuid = result['_id']
             new_obj.criteria_type = result['_type']
             results.append(new_obj)
@@ -136,7 +136,7 @@ class RetrieveCriteriaMixin(RetrieveElasticMixin):
         s = Search(search_query=q, idx=getattr(self, 'idx'))
         try:
             result = s.get_json_response()['hits']['hits'][0]
-            obj = ElasticObject(initial=result['_source'])
+            obj = ElasticObject(initial=Criteria.get_criteria_source(result['_source']))
             obj.uuid = result['_id']
             obj.criteria_type = result['_type']
 
@@ -0,0 +1,52 @@
+from django.test import TestCase
+from unittest.mock import patch
+from criteria.helper.bulk_loader import CriteriaBulkLoader
+
+
+class CriteriaBulkLoaderTest(TestCase):
+    '''Test CriteriaBulkLoader'''
+
+    def get_docs(self, json_data):
+        return [line for line in json_data.split('\n') if line != '']
+
+    @patch('criteria.helper.bulk_loader.Loader')
+    def test_flush_by_doc_count(self, mock_loader):
+        loader = CriteriaBulkLoader('test_idx', 'test_type', max_docs=2)
+        for i in range(5):
+            loader.add('feature' + str(i), {'T1D': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}]})
+        self.assertEqual(mock_loader().bulk_load.call_count, 2, 'Sent two bulk requests of two docs')
+        loader.close()
+        self.assertEqual(mock_loader().bulk_load.call_count, 3, 'Sent the remaining doc on close')
+
+        json_data = mock_loader().bulk_load.call_args[0][2]
+        self.assertEqual(len(self.get_docs(json_data)), 2, 'Last request has one action and one doc')
+        self.assertIn('"_id": "feature4"', json_data)
+
+    @patch('criteria.helper.bulk_loader.Loader')
+    def test_flush_by_bytes(self, mock_loader):
+        loader = CriteriaBulkLoader('test_idx', 'test_type', max_docs=5000, max_bytes=100)
+        loader.add('feature1', {'T1D': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}]})
+        self.assertEqual(mock_loader().bulk_load.call_count, 1, 'Buffer over max_bytes is sent')
+        self.assertEqual(loader.buffer.tell(), 0, 'Buffer reset for reuse')
+        loader.close()
+        self.assertEqual(mock_loader().bulk_load.call_count, 1, 'Nothing left to send on close')
+
+    @patch('criteria.helper.bulk_loader.Loader')
+    def test_threaded(self, mock_loader):
+        loader = CriteriaBulkLoader('test_idx', 'test_type', max_docs=10, threaded=True)
+        for i in range(25):
+            loader.add('feature' + str(i), {'MS': [{'fid': 'MS', 'fname': 'MS'}]})
+        loader.close()
+        self.assertEqual(mock_loader().bulk_load.call_count, 3, 'Sent all bulk requests from the thread')
+        self.assertEqual(loader.loaded_count, 25, 'Loaded all the docs')
+
+    @patch('criteria.helper.bulk_loader.Loader')
+    def test_threaded_wait(self, mock_loader):
+        loader = CriteriaBulkLoader('test_idx', 'test_type', max_docs=10, threaded=True)
+        for i in range(15):
+            loader.add('feature' + str(i), {'MS': [{'fid': 'MS', 'fname': 'MS'}]})
+        loader.wait()
+        self.assertEqual(mock_loader().bulk_load.call_count, 2, 'Sent the queued and buffered docs')
+        loader.add('feature15', {'MS': [{'fid': 'MS', 'fname': 'MS'}]})
+        loader.close()
+        self.assertEqual(mock_loader().bulk_load.call_count, 3, 'Loader still usable after wait')
@@ -3,8 +3,15 @@ from elastic.elastic_settings import ElasticSettings
 import os
 import criteria
 from data_pipeline.utils import IniParser
-from criteria.helper.criteria import Criteria
+from criteria.helper.criteria import Criteria, criteria_fields
 from criteria.helper.criteria_manager import CriteriaManager
+from criteria.helper.gene_criteria import GeneCriteria
+from criteria.helper.bulk_loader import CriteriaBulkLoader
+from elastic.search import Search
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock
+import json
+import pickle
 
 IDX_SUFFIX = ElasticSettings.getattr('TEST')
 MY_INI_FILE = os.path.join(os.path.dirname(__file__), IDX_SUFFIX + '_test_criteria.ini')
@@ -77,6 +84,15 @@ class CriteriaTest(TestCase):
         match_all_query_dict = match_all_query.__dict__
         self.assertTrue('match_all' in str(match_all_query_dict))
 
+        section = "is_an_index_snp"
+        filtered_query_dict = Criteria.get_elastic_query(section, config).__dict__
+        self.assertTrue('must_not' in str(filtered_query_dict), 'disease_locus TBC filtered out')
+        self.assertTrue('exists' in str(filtered_query_dict), 'marker and disease must exist')
+        self.assertTrue("'status'" in str(filtered_query_dict), 'status filtered')
+
+        section = "gene_in_region"
+        self.assertIsNone(Criteria.get_section_filter(config[section]), 'no filter keys in the section')
+
     def test_get_criteria_dict(self):
 
         expected_dict = {'fid': 'GDXHsS00004', 'fname': 'Barrett'}
@@ -143,6 +159,160 @@ class CriteriaTest(TestCase):
         available_diseases = sorted(core_disease + other_disease)
         self.assertEqual(result_diseases, available_diseases)
 
+    def test_tag_feature_to_all_diseases_compact(self):
+        config = IniParser().read_ini(MY_INI_FILE)
+        section = "is_marker_in_mhc"
+        config[section]['compact_all_diseases'] = 'true'
+        result = Criteria.tag_feature_to_all_diseases('rs6679677', section, config, {})
+        self.assertEqual(list(result['rs6679677'].keys()), [Criteria.ALL_DISEASES], 'One entry for all diseases')
+
+        row = result['rs6679677']
+        doc = Criteria.get_criteria_doc('rs6679677', row)
+        self.assertIn(Criteria.ALL_DISEASES, row, 'Row of the caller not changed')
+        self.assertTrue(doc[Criteria.ALL_DISEASES])
+        self.assertEqual(doc['disease_tags'], [], 'Only the flag is stored')
+        self.assertEqual(doc['score'], Criteria.calculate_score(Criteria.site_enabled_diseases))
+
+        doc = Criteria.expand_all_diseases(doc)
+        self.assertEqual(sorted(doc['disease_tags']), sorted(Criteria.site_enabled_diseases), 'Expanded tags')
+        for disease in Criteria.site_enabled_diseases:
+            self.assertEqual(doc[disease], [{'fid': disease, 'fname': disease}], 'Expanded disease entry')
+
+    def test_disease_filter(self):
+        query = Criteria.get_disease_filter(['T1D', 'MS'])
+        self.assertIn('terms', str(query.__dict__), 'Any diseases filter on the disease_tags terms')
+
+        query = Criteria.get_disease_filter(['T1D', 'MS'], match_all=True)
+        self.assertIn('disease_tags', str(query.__dict__), 'All diseases filter on the disease_tags terms')
+        self.assertIn('MS', str(query.__dict__))
+        self.assertNotIn('script', str(query.__dict__))
+        self.assertIn(Criteria.ALL_DISEASES, str(query.__dict__), 'Features tagged with the all_diseases flag')
+
+    def test_get_docs_by_ids_field(self):
+        docs = [MagicMock(id='rs1', seqid='1'), MagicMock(id='rs1', seqid='2'), MagicMock(id='rs2', seqid='3')]
+        with patch('criteria.helper.criteria.Search') as mock_search:
+            mock_search.return_value.search.side_effect = [MagicMock(hits_total=3, docs=docs[:2]),
+                                                           MagicMock(hits_total=3, docs=docs),
+                                                           MagicMock(hits_total=0, docs=[])]
+            marker_docs = Criteria.get_docs_by_ids('idx', ['rs1', 'rs2'], field='id')
+            self.assertEqual(mock_search.call_args[1]['size'], 3, 'All the hits fetched, not truncated')
+            self.assertEqual(marker_docs, {'rs1': docs[0], 'rs2': docs[2]}, 'First doc of rs1 kept')
+
+            self.assertEqual(Criteria.get_docs_by_ids('idx', ['rs2', 'rs3'], field='id'), {'rs2': docs[2]})
+            self.assertEqual(Criteria.get_docs_by_ids('idx', ['rs3'], field='id'), {})
+            self.assertEqual(mock_search.call_count, 3, 'Docs and ids not found are cached')
+        Criteria.reset_build_caches()
+
+    def test_links_doc_layout(self):
+        fnotes = {'linkdata': 'rsq', 'linkvalue': 0.9, 'linkid': 'GDXHsS00004', 'linkname': 'Barrett JC'}
+        row = {'T1D': [{'fid': 'rs2476601', 'fname': 'rs2476601', 'fnotes': fnotes}],
+               'MS': [{'fid': 'rs2476601', 'fname': 'rs2476601', 'fnotes': fnotes}]}
+        doc = Criteria.get_criteria_doc('rs6679677', {disease: list(dicts) for disease, dicts in row.items()})
+        doc = Criteria.get_links_doc(doc)
+        self.assertNotIn('T1D', doc, 'No object per disease')
+        self.assertEqual(len(doc['links']), 2)
+        self.assertEqual(sorted(link['disease'] for link in doc['links']), ['MS', 'T1D'])
+        self.assertEqual(sorted(doc['disease_tags']), ['MS', 'T1D'], 'Disease tags kept')
+
+        props = Criteria.create_criteria_mapping('pydgin_imb_criteria_marker', 'rsq_with_index_snp', test_mode=True)
+        links_mapping = props.mapping_properties['rsq_with_index_snp']['properties']['links']
+        self.assertEqual(links_mapping['type'], 'nested', 'Links mapped as nested')
+        self.assertNotIn('T1D', props.mapping_properties['rsq_with_index_snp']['properties'])
+        Criteria.reset_build_caches()
+
+        source = Criteria.get_criteria_source(doc)
+        self.assertNotIn('links', source)
+        self.assertEqual(source['T1D'], row['T1D'], 'Converted back to the dict per disease')
+        self.assertEqual(source['MS'], row['MS'])
+
+    @patch('criteria.helper.bulk_loader.Loader')
+    def test_disease_partitions(self, mock_loader):
+        idx = 'pydgin_imb_criteria_gene'
+        self.assertTrue(Criteria.is_disease_partitioned('cand_gene_in_study'))
+        self.assertEqual(Criteria.get_disease_idx(idx, 'T1D', 'cand_gene_in_study'),
+                         Criteria.get_disease_alias(idx, 'T1D'), 'Partitioned type searched through the alias')
+        self.assertEqual(Criteria.get_disease_idx(idx, 'T1D', 'cand_gene_in_study,rsq_with_index_snp'), idx,
+                         'Criteria index searched if a type is not partitioned')
+
+        result_container = Criteria.populate_container('GDXHsS00004', 'Barrett', None, ['ENSG00000110800'],
+                                                       ['T1D', 'MS'], result_container={})
+        loader = CriteriaBulkLoader(idx, 'cand_gene_in_study')
+        Criteria.load_result_container(result_container, idx, 'cand_gene_in_study', loader=loader)
+        loader.close()
+
+        actions = [json.loads(line) for line in mock_loader().bulk_load.call_args[0][2].strip().split('\n')[::2]]
+        self.assertEqual(sorted(action['index']['_index'] for action in actions),
+                         sorted([idx, Criteria.get_partition_idx(idx, 'MS'), Criteria.get_partition_idx(idx, 'T1D')]),
+                         'Loaded in to the criteria index and the partition of each disease')
+        Criteria.reset_build_caches()
+
+    @patch('criteria.helper.bulk_loader.Loader')
+    def test_disease_partitions_all_diseases(self, mock_loader):
+        idx = 'pydgin_imb_criteria_gene'
+        result_container = Criteria.populate_container(Criteria.ALL_DISEASES, Criteria.ALL_DISEASES, None,
+                                                       ['ENSG00000229281'], [Criteria.ALL_DISEASES],
+                                                       result_container={})
+        loader = CriteriaBulkLoader(idx, 'is_gene_in_mhc')
+        Criteria.load_result_container(result_container, idx, 'is_gene_in_mhc', loader=loader)
+        loader.close()
+
+        lines = [json.loads(line) for line in mock_loader().bulk_load.call_args[0][2].strip().split('\n')]
+        partitions = {}
+        for (action, doc) in zip(lines[::2], lines[1::2]):
+            partitions[action['index']['_index']] = doc
+        for disease in Criteria.site_enabled_diseases:
+            doc = partitions[Criteria.get_partition_idx(idx, disease)]
+            self.assertTrue(doc[Criteria.ALL_DISEASES], 'Matched by the all_diseases filter of the partition')
+            self.assertEqual(doc['disease_tags'], [])
+        Criteria.reset_build_caches()
+
+    @patch.object(Criteria, 'get_meta_desc', return_value={})
+    def test_rollup(self, mock_meta_desc):
+        hits = [{'_type': 'cand_gene_in_study', '_source': {'qid': 'ENSG00000110800', 'score': 15,
+                                                             'disease_tags': ['T1D', 'AA']}},
+                {'_type': 'gene_in_region', '_source': {'qid': 'ENSG00000110800', 'score': 20,
+                                                         'disease_tags': ['T1D', 'MS']}},
+                {'_type': 'is_gene_in_mhc', '_source': {'qid': 'ENSG00000229281', 'score': 0, 'disease_tags': [],
+                                                         Criteria.ALL_DISEASES: True}}]
+        rollups = {}
+        for hit in hits:
+            Criteria.add_to_rollup(rollups, hit)
+
+        rollup = rollups['ENSG00000110800']
+        self.assertEqual(rollup['disease_tags'], ['T1D', 'AA', 'MS'], 'Union of the disease tags')
+        self.assertEqual(rollup['criteria'], {'cand_gene_in_study': ['T1D', 'AA'], 'gene_in_region': ['T1D', 'MS']})
+        self.assertEqual(rollup['score'], 35, 'Total score')
+        self.assertEqual(sorted(rollups['ENSG00000229281']['disease_tags']), sorted(Criteria.site_enabled_diseases),
+                         'All diseases expanded')
+
+        criteria_disease_tags = Criteria.get_criteria_disease_tags_from_rollups('idx', 'cand_gene_in_study',
+                                                                                rollups)
+        self.assertEqual(list(criteria_disease_tags.keys()), ['ENSG00000110800'], 'Only features with the criteria')
+        self.assertEqual(criteria_disease_tags['ENSG00000110800']['all'], ['T1D', 'AA'])
+        self.assertEqual(criteria_disease_tags['ENSG00000110800']['cand_gene_in_study'], ['T1D', 'AA'])
+
+        with patch('criteria.helper.criteria.Search') as mock_search:
+            mock_search.elastic_request.return_value.json.return_value = {'found': True, '_source': rollup}
+            self.assertEqual(Criteria.get_rollup('pydgin_imb_criteria_gene', 'ENSG00000110800'), rollup)
+            url = mock_search.elastic_request.call_args[0][1]
+            self.assertTrue(url.startswith(Criteria.get_rollup_idx('pydgin_imb_criteria_gene') + '/'),
+                            'Rollups are in their own index, not in the criteria index')
+
+        mock_meta_desc.return_value = {'idx': {'cand_gene_in_study': 'Candidate Gene', 'gene_in_region': 'Region'}}
+        criteria_hit = {'_index': 'idx', '_type': 'gene_in_region',
+                        '_source': {'qid': 'ENSG00000134242', 'disease_tags': ['RA']}}
+        with patch.object(Criteria, 'get_rollups', return_value={'ENSG00000110800': rollup}), \
+                patch('criteria.helper.criteria.Search') as mock_search:
+            mock_search.return_value.get_json_response.return_value = {'hits': {'hits': [criteria_hit]}}
+            criteria_disease_tags = Criteria.get_all_criteria_disease_tags(['ENSG00000110800', 'ENSG00000134242'],
+                                                                           'idx', None)
+            query = str(mock_search.call_args[0][0].__dict__)
+        self.assertNotIn('ENSG00000110800', query, 'Feature with a rollup not searched')
+        self.assertIn('ENSG00000134242', query, 'Feature without a rollup searched in the criteria index types')
+        self.assertEqual(sorted(criteria_disease_tags['ENSG00000110800']['all']), ['AA', 'MS', 'T1D'])
+        self.assertEqual(criteria_disease_tags['ENSG00000134242']['gene_in_region'], ['RA'])
+        self.assertEqual(criteria_disease_tags['ENSG00000134242']['all'], ['RA'])
+
     def test_available_criterias(self):
         feature = 'gene'
         available_criterias = Criteria.get_available_criterias(feature, INI_CONFIG)
@@ -214,3 +384,208 @@ class CriteriaTest(TestCase):
         identifiers = ['ptpn22', 'rs2476601', '1p13.2', 'ctla4', 'GDXHsS00025', 'foo', 'bar']
         criteria_disease_tags = Criteria.do_criteria_search(identifiers)
         print(criteria_disease_tags)
+
+    @classmethod
+    def mock_scan(cls, pages):
+        ''' Mock of Search.elastic_request for a scan, the first (search_type=scan) response has no hits and a
+        scroll id for each of the shards, the scroll requests then return the pages of hits for the scroll id. '''
+        scroll_pages = {}
+
+        def elastic_request(url, url_search, data=None, is_post=True):
+            response = MagicMock()
+            if '_search?search_type=scan' in url_search:
+                scroll_id = url_search.split('preference=_shards:')[1]
+                scroll_pages[scroll_id] = [[{'_id': hit_id + '_' + scroll_id, '_source': {}} for hit_id in page]
+                                           for page in pages]
+                response.json.return_value = {'_scroll_id': scroll_id, 'hits': {'hits': []}}
+            else:
+                hits = scroll_pages[data].pop(0) if len(scroll_pages[data]) > 0 else []
+                response.json.return_value = {'_scroll_id': data, 'hits': {'hits': hits}}
+            return response
+        return elastic_request
+
+    class ScanCriteria(Criteria):
+
+        @classmethod
+        def tag_feature_to_disease(cls, hit, section, config, result_container={}):
+            return cls.populate_container(hit['_id'], hit['_id'], None, ['ENSG00000110800'], ['T1D'],
+                                          result_container=result_container)
+
+    @patch('criteria.helper.criteria.ProcessPoolExecutor', ThreadPoolExecutor)
+    @patch.object(Criteria, 'get_scan_shards', return_value=5)
+    def test_scan_slices(self, mock_shards):
+        ''' Test scan_slices divides the shards between the slices, each scanned with its own preference, and
+        merges the results of the slices. The slices are run in threads so that the mocked requests are used. '''
+        config = IniParser().read_ini(MY_INI_FILE)
+        with patch.object(Search, 'elastic_request', side_effect=self.mock_scan([['h1', 'h2'], ['h3']])) as request:
+            result_container = Criteria.scan_slices('src_idx/hits', None, 'cand_gene_in_study', config,
+                                                    self.ScanCriteria, 2)
+
+        url_searches = [call[0][1] for call in request.call_args_list if 'search_type=scan' in call[0][1]]
+        self.assertEqual(sorted(url_searches),
+                         ['src_idx/hits/_search?search_type=scan&scroll=5m&preference=_shards:0,2,4',
+                          'src_idx/hits/_search?search_type=scan&scroll=5m&preference=_shards:1,3'],
+                         'Shards divided between the slices')
+        scan_data = [json.loads(call[1]['data']) for call in request.call_args_list
+                     if 'search_type=scan' in call[0][1]]
+        self.assertEqual(scan_data[0], {'query': {'match_all': {}}, 'size': 1000}, 'Scan of all the documents')
+        fids = sorted(criteria_dict['fid'] for criteria_dict in result_container['ENSG00000110800']['T1D'])
+        self.assertEqual(fids, sorted(hit_id + '_' + shard_ids for shard_ids in ['0,2,4', '1,3']
+                                      for hit_id in ['h1', 'h2', 'h3']), 'Merged the hits of all the pages')
+
+        with patch.object(Search, 'elastic_request', side_effect=self.mock_scan([['h1']])) as request:
+            Criteria.scan_slices('src_idx/hits', None, 'cand_gene_in_study', config, self.ScanCriteria, 8)
+        url_searches = [call[0][1] for call in request.call_args_list if 'search_type=scan' in call[0][1]]
+        self.assertEqual(len(url_searches), 5, 'Slices limited to the number of shards')
+
+    def test_scan_slice(self):
+        ''' Test scan_slice scrolls until a page has no hits, the first response of the scan having none. '''
+        config = IniParser().read_ini(MY_INI_FILE)
+        with patch.object(Search, 'elastic_request', side_effect=self.mock_scan([['h1'], ['h2']])) as request:
+            result_container = Criteria.scan_slice('src_idx/hits', None, 'cand_gene_in_study', config,
+                                                   self.ScanCriteria, ['0', '1'])
+        self.assertEqual(request.call_count, 4, 'Scan request and three scroll requests')
+        self.assertEqual(request.call_args_list[1][0][1], '_search/scroll?scroll=5m', 'Scrolled with the scroll id')
+        self.assertEqual(request.call_args_list[1][1]['data'], '0,1')
+        fids = [criteria_dict['fid'] for criteria_dict in result_container['ENSG00000110800']['T1D']]
+        self.assertEqual(fids, ['h1_0,1', 'h2_0,1'], 'Processed the pages of hits')
+
+    def test_scan_slice_pickle(self):
+        ''' Test the arguments of a slice can be sent to a worker process of the pool. '''
+        config = IniParser().read_ini(MY_INI_FILE)
+        query = Criteria.get_elastic_query('cand_gene_in_study', config)
+        args = pickle.loads(pickle.dumps(('src_idx/hits', query, 'cand_gene_in_study', config, GeneCriteria,
+                                          ['0'])))
+        self.assertEqual(args[3]['cand_gene_in_study']['feature'], 'gene', 'config survives pickling')
+        self.assertIs(args[4], GeneCriteria, 'sub_class survives pickling')
+        self.assertEqual(args[1].query, query.query, 'query survives pickling')
+
+    @patch('criteria.helper.criteria.CriteriaBulkLoader')
+    def test_scan_slice_stream(self, mock_loader):
+        ''' Test scan_slice flushes the results page by page or every flush_pages pages. '''
+        config = IniParser().read_ini(MY_INI_FILE)
+        pages = [['h1'], ['h2'], ['h3']]
+        with patch.object(Search, 'elastic_request', side_effect=self.mock_scan(pages)), \
+                patch.object(Criteria, 'upsert_result_container') as upsert_result_container:
+            result_container = Criteria.scan_slice('src_idx/hits', None, 'cand_gene_in_study', config,
+                                                   self.ScanCriteria, ['0'], stream_to=('criteria_idx', 'gene'))
+        # the three pages of hits (the first response of the scan has none) and the rest at the end of the scan
+        self.assertEqual(upsert_result_container.call_count, 4, 'Flushed page by page')
+        flushed = [call[0][0] for call in upsert_result_container.call_args_list]
+        self.assertIn('ENSG00000110800', flushed[0], 'Flushed the first page of hits')
+        self.assertEqual(flushed[3], {}, 'Nothing left at the end of the scan')
+        self.assertEqual(result_container, {}, 'Results left to the loader')
+        self.assertEqual(mock_loader().close.call_count, 1, 'Closed the loader')
+
+        mock_loader.reset_mock()
+        with patch.object(Search, 'elastic_request', side_effect=self.mock_scan(pages)), \
+                patch.object(Criteria, 'upsert_result_container') as upsert_result_container:
+            Criteria.scan_slice('src_idx/hits', None, 'cand_gene_in_study', config, self.ScanCriteria, ['0'],
+                                stream_to=('criteria_idx', 'gene'), flush_pages=2)
+        # flushed after the 2nd page of hits and the rest at the end of the scan
+        self.assertEqual(upsert_result_container.call_count, 2, 'Flushed every flush_pages pages of hits')
+        fids = [[criteria_dict['fid'] for criteria_dict in call[0][0]['ENSG00000110800']['T1D']]
+                for call in upsert_result_container.call_args_list]
+        self.assertEqual(fids, [['h1_0', 'h2_0'], ['h3_0']], 'Flushed the pages in the results')
+        self.assertEqual(mock_loader().close.call_count, 1, 'Closed the loader')
+
+    def test_merge_result_containers(self):
+        result_container = Criteria.populate_container('GDXHsS00004', 'Barrett', None, ['ENSG00000110800'], ['T1D'],
+                                                       result_container={})
+        other_container = Criteria.populate_container('GDXHsS00004', 'Barrett', None, ['ENSG00000110800'],
+                                                      ['T1D', 'MS'], result_container={})
+        other_container = Criteria.populate_container('GDXHsS00005', 'Catfield', None, ['ENSG00000163599'], ['RA'],
+                                                      result_container=other_container)
+
+        merged = Criteria.merge_result_containers(result_container, other_container)
+        expected_result = {'ENSG00000110800': {'T1D': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}],
+                                               'MS': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}]},
+                           'ENSG00000163599': {'RA': [{'fid': 'GDXHsS00005', 'fname': 'Catfield'}]}}
+        self.assertEqual(merged, expected_result, 'Merged containers without duplicates')
+
+    def test_get_first_author(self):
+        Criteria.reset_build_caches()
+        Criteria.lookup_counters.clear()
+        study_lookup = Criteria.get_study_lookup()
+        self.assertTrue(len(study_lookup) > 0, 'Loaded the study lookup')
+
+        study_id = list(study_lookup.keys())[0]
+        first_author = Criteria.get_first_author(study_id)
+        self.assertEqual(first_author, study_lookup[study_id]['first_author'], 'Got first author from the lookup')
+        self.assertEqual(Criteria.lookup_counters['study_lookup'], {'hits': 1, 'misses': 0}, 'Counted the hit')
+        Criteria.lookup_counters.clear()
+
+    def test_process_page_batch(self):
+
+        class BatchCriteria(Criteria):
+
+            @classmethod
+            def cand_gene_in_study_batch(cls, hits, section=None, config=None, result_container={}):
+                for hit in hits:
+                    result_container = cls.populate_container(hit['_id'], hit['_id'], None, ['ENSG00000110800'],
+                                                              ['T1D'], result_container=result_container)
+                return result_container
+
+        hits = [{'_id': 'GDXHsS00004', '_source': {}}, {'_id': 'GDXHsS00005', '_source': {}}]
+        result_container = Criteria.process_page(hits, 'cand_gene_in_study', None, BatchCriteria, {})
+        expected_result = {'ENSG00000110800': {'T1D': [{'fid': 'GDXHsS00004', 'fname': 'GDXHsS00004'},
+                                                       {'fid': 'GDXHsS00005', 'fname': 'GDXHsS00005'}]}}
+        self.assertEqual(result_container, expected_result, 'Page passed to the batch criteria')
+
+    @patch('criteria.helper.bulk_loader.Loader')
+    def test_upsert_result_container(self, mock_loader):
+        Criteria.reset_build_caches()
+        result_container = Criteria.populate_container('GDXHsS00004', 'Barrett', None, ['ENSG00000110800'],
+                                                       ['T1D', 'MS'], result_container={})
+        loader = CriteriaBulkLoader('test_idx', 'cand_gene_in_study')
+        with patch.object(Criteria, 'is_disease_partitioned', return_value=False), \
+                patch.object(Search, 'elastic_request') as request:
+            Criteria.upsert_result_container(result_container, loader)
+            loader.wait()
+            self.assertFalse(request.called, 'Nothing to merge for a feature that is not flushed yet')
+            lines = mock_loader().bulk_load.call_args[0][2].strip().split('\n')
+            self.assertEqual(len(lines), 2, 'One index action and its doc')
+            self.assertEqual(json.loads(lines[0])['index']['_id'], 'ENSG00000110800')
+            flushed_doc = json.loads(lines[1])
+            self.assertEqual(flushed_doc['score'], Criteria.calculate_score(['T1D', 'MS']))
+
+            request.return_value.json.return_value = {'docs': [{'_id': 'ENSG00000110800', 'found': True,
+                                                                '_source': flushed_doc}]}
+            other_container = Criteria.populate_container('GDXHsS00004', 'Barrett', None, ['ENSG00000110800'],
+                                                          ['T1D'], result_container={})
+            other_container = Criteria.populate_container('GDXHsS00005', 'Catfield', None, ['ENSG00000110800'],
+                                                          ['RA'], result_container=other_container)
+            Criteria.upsert_result_container(other_container, loader)
+            loader.close()
+
+        self.assertEqual(request.call_args[0][1], 'test_idx/cand_gene_in_study/_mget', 'Read back the flushed doc')
+        lines = mock_loader().bulk_load.call_args[0][2].strip().split('\n')
+        self.assertNotIn('script', lines[0], 'Whole document loaded, no update script')
+        doc = json.loads(lines[1])
+        self.assertEqual(doc['T1D'], [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}], 'Merged without duplicates')
+        self.assertEqual(doc['MS'], [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}], 'Kept the flushed criteria')
+        self.assertEqual(doc['RA'], [{'fid': 'GDXHsS00005', 'fname': 'Catfield'}], 'Added the new criteria')
+        self.assertEqual(sorted(doc['disease_tags']), ['MS', 'RA', 'T1D'])
+        self.assertEqual(doc['score'], Criteria.calculate_score(['T1D', 'MS', 'RA']))
+        Criteria.reset_build_caches()
+
+    def test_criteria_fields(self):
+        config = IniParser().read_ini(MY_INI_FILE)
+        self.assertEqual(Criteria.get_source_fields('cand_gene_in_region', config),
+                         ['disease_locus', 'genes', 'disease', 'status'], 'Declared fields used as the projection')
+        self.assertTrue('disease_locus' in str(Criteria.get_elastic_query('cand_gene_in_region', config).__dict__))
+
+        class FieldsCriteria(Criteria):
+
+            @classmethod
+            @criteria_fields('study_id')
+            def study_for_disease(cls, hit, section=None, config=None, result_container={}):
+                return hit['_source']['diseases']
+
+        hit = {'_id': 'GDXHsS00004', '_source': {'study_id': 'GDXHsS00004', 'diseases': ['T1D']}}
+        self.assertEqual(FieldsCriteria.study_for_disease(hit), ['T1D'], 'Fields not checked outside test mode')
+        Criteria.check_fields = True
+        try:
+            self.assertRaises(KeyError, FieldsCriteria.study_for_disease, hit)
+        finally:
+            Criteria.check_fields = False
@@ -6,6 +6,10 @@ import criteria
 from data_pipeline.utils import IniParser
 import shutil
 from disease import utils
+from criteria.helper.criteria import Criteria
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+import io
 
 IDX_SUFFIX = ElasticSettings.getattr('TEST')
 MY_INI_FILE = os.path.join(os.path.dirname(__file__), IDX_SUFFIX + '_test_criteria.ini')
@@ -68,3 +72,73 @@ class CriteriaManagerTest(TestCase):
         criteria_list = CriteriaManager.process_criterias(feature, criteria=criteria, config=None, show=True)
         self.assertIn('cand_gene_in_study', criteria_list, 'cand_gene_in_study in list')
         self.assertNotIn('is_gene_in_mhc', criteria_list, 'is_gene_in_mhc not in in list')
+
+    def test_get_criteria_class(self):
+        from criteria.helper.gene_criteria import GeneCriteria
+        from criteria.helper.marker_criteria import MarkerCriteria
+        self.assertEqual(CriteriaManager.get_criteria_class('gene'), GeneCriteria, 'Got GeneCriteria for gene')
+        self.assertEqual(CriteriaManager.get_criteria_class('marker'), MarkerCriteria, 'Got MarkerCriteria for marker')
+        self.assertIsNone(CriteriaManager.get_criteria_class('foo'), 'No criteria class for unknown feature')
+
+    def test_plan_shared_scans(self):
+        config = CriteriaManager.get_criteria_config(ini_file='criteria.ini')
+        feature_sections = [('gene', 'cand_gene_in_region'), ('gene', 'is_gene_in_mhc'),
+                            ('marker', 'is_an_index_snp'), ('marker', 'rsq_with_index_snp'),
+                            ('gene', 'gene_in_region')]
+        scan_groups = CriteriaManager.plan_shared_scans(feature_sections, config)
+        expected_groups = [[('gene', 'cand_gene_in_region'), ('marker', 'is_an_index_snp'),
+                            ('marker', 'rsq_with_index_snp')],
+                           [('gene', 'is_gene_in_mhc')],
+                           [('gene', 'gene_in_region')]]
+        self.assertEqual(scan_groups, expected_groups, 'STUDY_HITS sections share one scan')
+
+    def test_process_criterias_workers(self):
+        ''' Test process_criterias with workers returns the wall time of the sections that are built and reports
+        the sections that fail. The pool is run in threads so that the mocked process_section is used. '''
+        def process_section(feature, section, config, sub_class, test=False, slices=None):
+            if section == 'section_fail':
+                raise ValueError('section failed')
+            return (section, 1.5)
+
+        with patch.object(Criteria, 'get_available_criterias',
+                          return_value={'gene': ['section_ok', 'section_fail']}), \
+                patch.object(Criteria, 'get_criteria_idx', return_value='criteria_gene'), \
+                patch.object(Criteria, 'create_criteria_mapping') as create_criteria_mapping, \
+                patch.object(CriteriaManager, 'process_section', side_effect=process_section) as mock_section, \
+                patch('criteria.helper.criteria_manager.ProcessPoolExecutor', ThreadPoolExecutor), \
+                patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            section_times = CriteriaManager.process_criterias('gene', config={}, test=True, workers=2)
+
+        self.assertEqual(section_times, {'section_ok': 1.5}, 'Got the wall time of the section built')
+        self.assertEqual(mock_section.call_count, 2, 'Built both sections')
+        self.assertEqual(create_criteria_mapping.call_count, 2, 'Created the mappings up front')
+        self.assertIn('with 2 workers', stdout.getvalue())
+        self.assertRegex(stdout.getvalue(), r'section_ok\s+1\.5', 'Reported the section time')
+        self.assertRegex(stdout.getvalue(), r'section_fail\s+FAILED', 'Reported the failed section')
+
+    def test_process_criterias_rollup(self):
+        ''' Test the rollup of a feature is dropped at the start of a build and only built again once all of the
+        criteria of the feature have been built. '''
+        def process_section(feature, section, config, sub_class, test=False, slices=None):
+            if section == 'section_fail':
+                raise ValueError('section failed')
+            return (section, 1.5)
+
+        def process_criterias(available_criterias, **kwargs):
+            with patch.object(Criteria, 'get_available_criterias', return_value={'gene': available_criterias}), \
+                    patch.object(Criteria, 'get_criteria_idx', return_value='criteria_gene'), \
+                    patch.object(Criteria, 'create_criteria_mapping'), \
+                    patch.object(Criteria, 'drop_rollup') as drop_rollup, \
+                    patch.object(Criteria, 'build_rollup') as build_rollup, \
+                    patch.object(CriteriaManager, 'process_section', side_effect=process_section), \
+                    patch('criteria.helper.criteria_manager.ProcessPoolExecutor', ThreadPoolExecutor), \
+                    patch('sys.stdout', new_callable=io.StringIO):
+                CriteriaManager.process_criterias('gene', config={}, **kwargs)
+            self.assertEqual(drop_rollup.call_count, 1, 'Dropped the rollup')
+            return build_rollup.call_count
+
+        self.assertEqual(process_criterias(['section_ok', 'section_ok2']), 1, 'Rollup after a full build')
+        self.assertEqual(process_criterias(['section_ok', 'section_ok2'], criteria='section_ok'), 0,
+                         'No rollup after a build of some of the criteria')
+        self.assertEqual(process_criterias(['section_ok', 'section_fail'], workers=2), 0,
+                         'No rollup after a build with a failed criteria')
@@ -193,10 +193,28 @@ class GeneCriteriaTest(TestCase):
                                              'UC': [{'fid': '1p36.12_008', 'fname': '1p36.12'}]}}
         self.assertEqual(criteria_results, expected_dict, 'Got regions in gene as expected')
 
+        # pass the region hit as scrolled, with the _source projected on the fields of the section
+        source_fields = GeneCriteria.get_source_fields('gene_in_region', config)
+        projected_hit = dict(self.region_doc_full)
+        if len(source_fields) > 0:
+            projected_hit['_source'] = {field: value for field, value in self.region_doc_full['_source'].items()
+                                        if field in source_fields}
+        criteria_results = GeneCriteria.gene_in_region(projected_hit, config=config, result_container={})
+        self.assertEqual(criteria_results, expected_dict, 'Got regions in gene from the projected hit')
+
         criteria_results_17q = GeneCriteria.gene_in_region(self.region_doc_17q, config=config,
                                                            result_container={})
         self.assertTrue(len(criteria_results_17q) > 20, "Got back results greater than the default size")
 
+    def test_get_gene_coordinate_index(self):
+        gene_index = ElasticSettings.idx('GENE', idx_type='GENE')
+        gene_coordinates = GeneCriteria.get_gene_coordinate_index(gene_index)
+        self.assertIsNotNone(gene_coordinates, 'Loaded the gene coordinates')
+        genes = gene_coordinates.overlaps('1', 206767602, 206772494)
+        self.assertIn('ENSG00000136634', genes, 'Got IL10 back')
+        self.assertEqual(gene_coordinates, GeneCriteria.get_gene_coordinate_index(gene_index),
+                         'Gene coordinates loaded once per build')
+
     def test_cand_gene_in_study(self):
         config = IniParser().read_ini(MY_INI_FILE)
 
@@ -298,6 +316,21 @@ class GeneCriteriaTest(TestCase):
                                                        'fname': 'rs2476601'}]}}
         self.assertEqual(criteria_results, expected_result, 'Got back expected result')
 
+    def test_exonic_index_snp_in_gene_prefetch(self):
+        ''' Test exonic_index_snp_in_gene_prefetch. '''
+        GeneCriteria.reset_build_caches()
+        GeneCriteria.exonic_index_snp_in_gene_prefetch([self.region_hit])
+        self.assertIn('rs2476601', GeneCriteria.build_caches['marker_docs'], 'Prefetched the marker doc')
+
+        ensembl_gene_ids = GeneCriteria.get_exonic_gene_ids('rs2476601')
+        self.assertEqual(sorted(ensembl_gene_ids), ['ENSG00000134242', 'ENSG00000226167'], 'Got the gene ids')
+        self.assertIsNone(GeneCriteria.get_marker_docs(['rs_not_a_marker'])['rs_not_a_marker'], 'Marker not found')
+
+        GeneCriteria.reset_build_caches()
+        marker_docs = GeneCriteria.get_marker_docs(['rs2476601', 'rs_not_a_marker'], batch_size=1)
+        self.assertIsNotNone(marker_docs['rs2476601'], 'Marker found in a batch of one')
+        self.assertIsNone(marker_docs['rs_not_a_marker'], 'Marker not found in a batch of one')
+
     def test_tag_feature_to_disease(self):
         ''' Test tag_feature_to_disease. '''
         config = IniParser().read_ini(MY_INI_FILE)
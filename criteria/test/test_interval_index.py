@@ -0,0 +1,30 @@
+from django.test import TestCase
+from criteria.helper.interval_index import IntervalIndex
+
+
+class IntervalIndexTest(TestCase):
+    '''Test IntervalIndex'''
+
+    def setUp(self):
+        self.interval_index = IntervalIndex()
+        self.interval_index.add(('38', '1'), 100, 200, 'region1')
+        self.interval_index.add(('38', '1'), 150, 5000, 'region2')
+        self.interval_index.add(('38', '1'), 300, 400, 'region3')
+        self.interval_index.add(('38', '2'), 100, 200, 'region4')
+
+    def test_overlaps(self):
+        self.assertEqual(self.interval_index.overlaps(('38', '1'), 180, 350), ['region1', 'region2', 'region3'],
+                         'Got the overlapping regions in start order')
+        self.assertEqual(self.interval_index.overlaps(('38', '1'), 1000, 1100), ['region2'],
+                         'Got region spanning the query')
+        self.assertEqual(self.interval_index.overlaps(('38', '1'), 200, 200), ['region1', 'region2'],
+                         'Overlap bounds are inclusive')
+        self.assertEqual(self.interval_index.overlaps(('38', '1'), 5001, 6000), [], 'No overlaps')
+        self.assertEqual(self.interval_index.overlaps(('38', '3'), 100, 200), [], 'No intervals for key')
+        self.assertEqual(len(self.interval_index), 4, 'Four intervals in the index')
+
+    def test_add_after_query(self):
+        self.assertEqual(self.interval_index.overlaps(('38', '2'), 0, 1000), ['region4'])
+        self.interval_index.add(('38', '2'), 50, 60, 'region5')
+        self.assertEqual(self.interval_index.overlaps(('38', '2'), 0, 1000), ['region5', 'region4'],
+                         'Intervals added after a query are found')
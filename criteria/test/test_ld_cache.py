@@ -0,0 +1,43 @@
+from django.test import TestCase
+import os
+import tempfile
+from criteria.helper.ld_cache import LDCache
+
+
+class LDCacheTest(TestCase):
+    '''Test the on-disk LD cache'''
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_get_put(self):
+        ld_cache = LDCache(self.path, 'v1')
+        self.assertIsNone(ld_cache.get('EUR', 'rs123', 0, 0.8), 'marker not cached')
+
+        marker_list = [{'marker2': 'rs456', 'rsquared': 0.9, 'dprime': 1}]
+        ld_cache.put('EUR', 'rs123', 0, 0.8, marker_list)
+        self.assertEqual(ld_cache.get('EUR', 'rs123', 0, 0.8), marker_list, 'marker cached')
+        self.assertIsNone(ld_cache.get('EUR', 'rs123', 0, 0.9), 'different rsq not cached')
+        self.assertIsNone(ld_cache.get('AFR', 'rs123', 0, 0.8), 'different dataset not cached')
+
+        ld_cache.put_many('EUR', 0, 0.8, {'rs1': [], 'rs2': marker_list})
+        self.assertEqual(ld_cache.get('EUR', 'rs1', 0, 0.8), [], 'empty LD list cached')
+        self.assertEqual(ld_cache.get('EUR', 'rs2', 0, 0.8), marker_list, 'marker cached')
+        ld_cache.close()
+
+    def test_panel_version(self):
+        ld_cache = LDCache(self.path, 'v1')
+        ld_cache.put('EUR', 'rs123', 0, 0.8, [])
+        ld_cache.close()
+
+        ld_cache = LDCache(self.path, 'v1')
+        self.assertEqual(ld_cache.get('EUR', 'rs123', 0, 0.8), [], 'same panel version kept')
+        ld_cache.close()
+
+        ld_cache = LDCache(self.path, 'v2')
+        self.assertIsNone(ld_cache.get('EUR', 'rs123', 0, 0.8), 'cleared when the panel version changes')
+        ld_cache.close()
@@ -0,0 +1,33 @@
+from django.test import TestCase
+import os
+import tempfile
+from criteria.helper.ld_table import LDTable
+
+
+class LDTableTest(TestCase):
+    '''Test the memory-mapped LD table'''
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(suffix='.ld')
+        os.close(fd)
+        pairs = [('rs2', 'rs1', 0.9, 1.0), ('rs2', 'rs3', 0.5, 0.8), ('rs10', 'rs2', 0.95, 0.6)]
+        LDTable.write(self.path, pairs)
+        self.table = LDTable(self.path)
+
+    def tearDown(self):
+        self.table.close()
+        os.remove(self.path)
+
+    def test_ld(self):
+        ld = self.table.ld('rs2', dprime=0, rsq=0.8)
+        self.assertEqual([m['marker2'] for m in ld['ld']], ['rs10', 'rs1'], 'ordered by rsquared')
+        self.assertEqual(ld['ld'][1], {'marker2': 'rs1', 'rsquared': 0.9, 'dprime': 1.0})
+
+        ld = self.table.ld('rs2', dprime=0.7, rsq=0.5)
+        self.assertEqual([m['marker2'] for m in ld['ld']], ['rs1', 'rs3'], 'dprime and rsq thresholds')
+
+        ld = self.table.ld('rs3', dprime=0, rsq=0.5)
+        self.assertEqual([m['marker2'] for m in ld['ld']], ['rs2'], 'pairs stored in both directions')
+
+        self.assertEqual(self.table.ld('rs1', rsq=0.95)['ld'], [], 'no markers above rsq')
+        self.assertIn('error', self.table.ld('rs4'), 'marker not in the table')
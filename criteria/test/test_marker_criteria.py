@@ -199,7 +199,29 @@ class MarkerCriteriaTest(TestCase):
         p_val_to_compare = float(criteria_results_fnotes['linkvalue'])
         self.assertTrue(p_val_to_compare < gw_sig_p, 'p val less than gwas significant pvalue')
 
+    def test_get_index_meta(self):
+        MarkerCriteria.reset_build_caches()
+        idx = self.ic_stats1['_index']
+        idx_type = self.ic_stats1['_type']
+        MarkerCriteria.prefetch_index_meta(idx)
+        self.assertIn(('index_meta', idx, idx_type), MarkerCriteria.build_caches, 'prefetched the index meta')
+
+        meta_info = MarkerCriteria.get_index_meta(idx, idx_type)
+        self.assertIn('disease', meta_info, 'disease in the index meta')
+        self.assertIn('study', meta_info, 'study in the index meta')
+
     @override_settings(ELASTIC=PydginTestSettings.OVERRIDE_SETTINGS)
+    def test_get_marker_seqids(self):
+        ''' Test get_marker_seqids batches the queries and caches the markers that are not found. '''
+        MarkerCriteria.reset_build_caches()
+        marker_seqids = MarkerCriteria.get_marker_seqids(['rs2476601', 'rs_not_a_marker'], batch_size=1)
+        self.assertIn('rs2476601', marker_seqids, 'Got the seqid of rs2476601')
+        self.assertNotIn('rs_not_a_marker', marker_seqids, 'Marker not found')
+        marker_idx = ElasticSettings.idx('MARKER', 'MARKER')
+        self.assertIn('rs_not_a_marker', MarkerCriteria.build_caches[('docs', marker_idx, 'id')],
+                      'Marker not found is cached')
+        self.assertIsNone(MarkerCriteria.get_marker_seqid('rs_not_a_marker'), 'No seqid for marker not found')
+
     def test_get_disease_tags(self):
         config = IniParser().read_ini(MY_INI_FILE)
         idx = ElasticSettings.idx('MARKER_CRITERIA')
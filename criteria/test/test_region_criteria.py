@@ -7,6 +7,7 @@ from criteria.helper.region_criteria import RegionCriteria
 from django.test.utils import override_settings
 from elastic.utils import ElasticUtils
 from pydgin.tests.data.settings_idx import PydginTestSettings
+from unittest.mock import patch, MagicMock
 
 IDX_SUFFIX = ElasticSettings.getattr('TEST')
 MY_INI_FILE = os.path.join(os.path.dirname(__file__), IDX_SUFFIX + '_test_criteria.ini')
@@ -105,6 +106,31 @@ class RegionCriteriaTest(TestCase):
 
         self.assertEqual(criteria_results, expected_dict, 'Got result dict for is_region_for_disease as expected')
 
+    def test_is_region_for_disease_hit_not_found(self):
+        hit = {'_id': '1p13.2_019', '_source': {'disease_loci': ['1p13.2_019_T1D'], 'region_id': '1p13.2_019'}}
+        disease_locus_docs = {'1p13.2_019_T1D': MagicMock(hits=['not_a_hit', 'hit'])}
+        study_hit_docs = {'hit': MagicMock(disease='T1D', status='N', disease_locus='1p13.2_019_T1D')}
+        with patch.object(RegionCriteria, 'get_disease_locus_docs', return_value=disease_locus_docs), \
+                patch.object(RegionCriteria, 'get_study_hit_docs', return_value=study_hit_docs):
+            criteria_results = RegionCriteria.is_region_for_disease(hit, result_container={})
+        self.assertEqual(criteria_results, {'1p13.2_019': {'T1D': [{'fid': 'T1D', 'fname': 'T1D'}]}},
+                         'Study hit not found skipped')
+
+    def test_is_region_for_disease_prefetch(self):
+
+        config = IniParser().read_ini(MY_INI_FILE)
+        RegionCriteria.reset_build_caches()
+        RegionCriteria.is_region_for_disease_prefetch([self.region_region1], config=config)
+
+        disease_locus_idx = ElasticSettings.idx('REGION', idx_type='DISEASE_LOCUS')
+        disease_locus_docs = RegionCriteria.build_caches[('docs', disease_locus_idx)]
+        self.assertEqual(len(disease_locus_docs), 7, 'Fetched the disease loci of the page')
+        study_hits_idx = ElasticSettings.idx('REGION', idx_type='STUDY_HITS')
+        self.assertTrue(len(RegionCriteria.build_caches[('docs', study_hits_idx)]) > 0, 'Fetched the study hits')
+
+        criteria_results = RegionCriteria.is_region_for_disease(self.region_region1, config=config, result_container={})
+        self.assertEqual(len(criteria_results['1p36.32_002']), 7, 'Got the same result from the prefetched docs')
+
     def test_is_region_in_mhc(self):
 
         config = IniParser().read_ini(MY_INI_FILE)
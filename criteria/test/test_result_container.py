@@ -0,0 +1,102 @@
+from django.test import TestCase
+import pickle
+from criteria.helper.criteria import Criteria
+from criteria.helper.result_container import CompactResultContainer, CriteriaList, DiskResultContainer
+import os
+from unittest.mock import patch
+
+
+class ResultContainerTest(TestCase):
+    '''Test the result container structures'''
+
+    def test_criteria_list(self):
+        fnotes = {'linkdata': 'rsq', 'linkvalue': 0.9, 'linkid': 'GDXHsS00004', 'linkname': 'Barrett JC'}
+        criteria_list = CriteriaList([{'fid': 'rs1', 'fname': 'rs1'}])
+        self.assertTrue(criteria_list.append({'fid': 'rs1', 'fname': 'rs1', 'fnotes': fnotes}), 'Added with fnotes')
+        self.assertFalse(criteria_list.append({'fname': 'rs1', 'fid': 'rs1'}), 'Duplicate not added')
+        self.assertFalse(criteria_list.append({'fid': 'rs1', 'fname': 'rs1', 'fnotes': dict(fnotes)}),
+                         'Duplicate with fnotes not added')
+        self.assertIn({'fid': 'rs1', 'fname': 'rs1'}, criteria_list)
+        self.assertEqual(criteria_list, [{'fid': 'rs1', 'fname': 'rs1'},
+                                         {'fid': 'rs1', 'fname': 'rs1', 'fnotes': fnotes}], 'Still a list of dicts')
+
+        criteria_list = pickle.loads(pickle.dumps(criteria_list))
+        self.assertFalse(criteria_list.append({'fid': 'rs1', 'fname': 'rs1'}), 'Keys kept when pickled')
+
+    def test_populate_container_dedup(self):
+        result_container = {}
+        for _i in range(3):
+            result_container = Criteria.populate_container('GDXHsS00004', 'Barrett', None,
+                                                           ['ENSG00000110800', 'ENSG00000163599'], ['T1D', 'MS'],
+                                                           result_container=result_container)
+        expected_result = {'ENSG00000110800': {'T1D': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}],
+                                               'MS': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}]},
+                           'ENSG00000163599': {'T1D': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}],
+                                               'MS': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}]}}
+        self.assertEqual(result_container, expected_result, 'No duplicates in the container')
+
+    def test_compact_result_container(self):
+        fnotes = {'linkdata': 'rsq', 'linkvalue': 0.9, 'linkid': 'GDXHsS00004', 'linkname': 'Barrett JC'}
+        result_container = CompactResultContainer()
+        dict_container = {}
+        for container in (result_container, dict_container):
+            for _i in range(2):
+                container = Criteria.populate_container('rs1', 'rs1', dict(fnotes), ['rs2', 'rs3'], ['T1D', 'MS'],
+                                                        result_container=container)
+                container = Criteria.populate_container('GDXHsS00004', 'Barrett', None, ['rs2'], ['T1D'],
+                                                        result_container=container)
+
+        self.assertEqual(dict(result_container.items()), dict_container, 'Same results as the dict container')
+        self.assertEqual(len(result_container), 2)
+        self.assertIn('rs2', result_container)
+        self.assertEqual(len(result_container.fnotes), 1, 'Equal fnotes stored once')
+        self.assertIs(result_container.features['rs2']['MS'][0], result_container.features['rs3']['T1D'][0],
+                      'Records shared between features and diseases')
+
+        doc = Criteria.get_criteria_doc('rs2', result_container['rs2'])
+        self.assertEqual(sorted(doc['disease_tags']), ['MS', 'T1D'])
+        self.assertEqual(doc['qid'], 'rs2')
+
+    def test_compact_result_container_large(self):
+        result_container = CompactResultContainer()
+        for i in range(100):
+            for _j in range(2):
+                Criteria.populate_container('rs' + str(i), 'rs' + str(i), None, ['rs0'], ['T1D'],
+                                            result_container=result_container)
+        self.assertEqual(len(result_container['rs0']['T1D']), 100, 'No duplicates in a long list')
+
+        for i in range(100):
+            fnotes = {'linkdata': 'rsq', 'linkvalue': 0.9, 'linkid': 'GDXHsS' + str(i), 'linkname': 'Barrett JC'}
+            for _j in range(2):
+                Criteria.populate_container('rs2476601', 'rs2476601', dict(fnotes), ['rs1'], ['T1D'],
+                                            result_container=result_container)
+        self.assertEqual(len(result_container['rs1']['T1D']), 100, 'No duplicates in a long list with fnotes')
+
+    def test_disk_result_container(self):
+        fnotes = {'linkdata': 'rsq', 'linkvalue': 0.9, 'linkid': 'GDXHsS00004', 'linkname': 'Barrett JC'}
+        result_container = DiskResultContainer(max_features=2)
+        dict_container = {}
+        for container in (result_container, dict_container):
+            for feature in ('rs1', 'rs2', 'rs3', 'rs1'):
+                container = Criteria.populate_container('rs2476601', 'rs2476601', fnotes, [feature], ['T1D', 'MS'],
+                                                        result_container=container)
+            container = Criteria.populate_container('rs6679677', 'rs6679677', None, ['rs1'], ['T1D'],
+                                                    result_container=container)
+
+        path = result_container.path
+        self.assertTrue(os.path.exists(path), 'Working set spilled to disk')
+        self.assertIn('rs1', result_container.working_set, 'rs1 in the working set and in the spill file')
+        with patch.object(DiskResultContainer, 'spill') as spill:
+            self.assertEqual(len(result_container), 3)
+            self.assertEqual(dict(result_container.items()), dict_container, 'Spilled features merged')
+            self.assertEqual(result_container['rs1'], dict_container['rs1'])
+            self.assertIn('rs1', result_container)
+            self.assertIn('rs2', result_container)
+            self.assertNotIn('rs4', result_container)
+            self.assertRaises(KeyError, result_container.__getitem__, 'rs4')
+            self.assertFalse(spill.called, 'Reads do not spill the working set')
+
+        result_container = pickle.loads(pickle.dumps(result_container))
+        self.assertEqual(dict(result_container.items()), dict_container, 'Spill file passed when pickled')
+        result_container.close()
+        self.assertFalse(os.path.exists(path), 'Spill file removed')
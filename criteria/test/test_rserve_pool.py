@@ -0,0 +1,73 @@
+from django.test import TestCase
+import json
+import os
+from criteria.helper.criteria import Criteria
+from criteria.helper.marker_criteria import MarkerCriteria
+from criteria.helper.rserve_pool import RservePool
+
+
+class FakeR(object):
+    ''' Stand-in for the pyRserve R namespace with an ld_run returning one marker in LD. '''
+
+    def ld_run(self, dataset, seqid, marker, dprime=0, rsq=0.8):
+        return json.dumps({'ld': [{'marker2': marker + '_ld', 'R.squared': 0.9, 'D.prime': 1}]})
+
+
+class FakeRserveConnection(object):
+    ''' Stand-in for a pyRserve connection. '''
+    connect_count = 0
+
+    def __init__(self, host=None, port=None):
+        FakeRserveConnection.connect_count += 1
+        self.r = FakeR()
+        self.closed = False
+
+    def eval(self, expr):
+        return [self.r.ld_run('EUR', '1', marker) for marker in self.r.ld_markers]
+
+    def close(self):
+        self.closed = True
+
+
+class RservePoolTest(TestCase):
+    '''Test RservePool and the batched LD calls with a fake Rserve'''
+
+    def setUp(self):
+        FakeRserveConnection.connect_count = 0
+        self.pool = RservePool('localhost', 6311, size=2, connect=FakeRserveConnection)
+        RservePool.pools[os.getpid()] = self.pool
+        Criteria.reset_build_caches()
+
+    def tearDown(self):
+        del RservePool.pools[os.getpid()]
+        Criteria.reset_build_caches()
+
+    def test_connections_reused(self):
+        for _i in range(5):
+            with self.pool.connection() as conn:
+                self.assertTrue(isinstance(conn, FakeRserveConnection))
+        self.assertEqual(FakeRserveConnection.connect_count, 1, 'One warm connection reused')
+
+        with self.pool.connection() as conn1:
+            with self.pool.connection() as conn2:
+                self.assertNotEqual(conn1, conn2, 'Second connection opened while the first is in use')
+        self.assertEqual(FakeRserveConnection.connect_count, 2)
+
+    def test_broken_connection_discarded(self):
+        try:
+            with self.pool.connection() as conn:
+                raise ValueError('R error')
+        except ValueError:
+            pass
+        self.assertTrue(conn.closed, 'Connection closed after an error')
+        self.assertEqual(self.pool.open_count, 0, 'Connection not returned to the pool')
+
+    def test_get_ld_batch(self):
+        ld_batch = MarkerCriteria.get_ld_batch('EUR', '1', ['rs1', 'rs2'])
+        self.assertEqual(ld_batch['rs1']['ld'], [{'marker2': 'rs1_ld', 'rsquared': 0.9, 'dprime': 1}])
+        self.assertEqual(ld_batch['rs2']['ld'][0]['marker2'], 'rs2_ld')
+
+        # served from the batch results without another R call
+        self.pool.connect = None
+        ld = MarkerCriteria.get_ld('EUR', '1', 'rs2')
+        self.assertEqual(ld['ld'][0]['marker2'], 'rs2_ld')